@@ -9,6 +9,7 @@ from langchain.agents import load_tools
 from langchain.agents import initialize_agent
 from langchain.llms import OpenAI
 
+from lib.quota import quota_governor
 from lib.utils import remove_control_characters
 
 
@@ -31,8 +32,13 @@ async def execute_agent_with_subprocess(query: str, fn_report: Optional[Callable
         if line == "" and proc.poll() is not None:
             break
         if line:
+            # 色付きの出力の場合，行頭に色指定が入るので先に除去する
+            line = remove_control_characters(line)
+            if line.strip().startswith("Action: Search"):
+                # Agent が SerpAPI で検索した
+                quota_governor.record("serpapi")
             if fn_report is not None:
-                fn_report(remove_control_characters(line))
+                fn_report(line)
         elapsed = time.time() - t0
         if elapsed > 80:
             # 80 秒以上かかっている場合は，強制終了する．
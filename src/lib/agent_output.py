@@ -0,0 +1,90 @@
+"""
+Google Home（LangChain の Agent）のログ出力の集約
+ログ出力を 1 行ずつ全て喋らせると行動の予約が溢れるため，喋る内容を選んでまとめます．
+"""
+import re
+from typing import Callable, List, Optional
+
+# 喋らずに読み飛ばすログ（Agent の思考過程など）
+AGENT_LOG_PATTERNS_TO_SKIP = [
+    r"^> Entering new .* chain",
+    r"^> Finished .*chain",
+    r"^Thought:",
+    r"^Action:",
+    r"^Action Input:",
+    r"^Observation:",
+]
+
+
+class AgentOutputAggregator:
+    def __init__(
+        self,
+        fn_speak: Callable[[str], None],
+        max_utterances: int = 2,
+        max_chars: int = 200,
+        thinking_cue: Optional[str] = "Let me see.",
+        fallback_answer: Optional[str] = "Sorry, I couldn't find the answer."
+    ):
+        """
+        Agent のログ出力を集約し，喋る内容を選ぶクラス．1 回の問い合わせにつき 1 つ作成する．
+        ----
+        Args:
+            fn_speak: 喋る内容を受け取る関数（行動の予約など）．
+            max_utterances: 1 回の問い合わせで喋る回数の上限．
+            max_chars: 1 回の発話の文字数の上限．
+            thinking_cue: 最初のログ出力を受け取った時に喋る「考え中」の合図．None の場合は喋らない．
+            fallback_answer: 最終回答が得られなかった場合に喋る内容．None の場合は喋らない．
+        """
+        self.fn_speak = fn_speak
+        self.max_utterances = max_utterances
+        self.max_chars = max_chars
+        self.thinking_cue = thinking_cue
+        self.fallback_answer = fallback_answer
+        self.num_utterances = 0
+        self.num_lines_skipped = 0
+        self.final_answer_lines: List[str] = []
+        self.is_in_final_answer = False
+
+    def feed(self, line: str):
+        """
+        ログ出力を 1 行受け取る．
+        """
+        line = line.strip()
+        if line == "":
+            return
+        if "Final Answer: " in line:
+            self.is_in_final_answer = True
+            line = line.split("Final Answer: ", 1)[1].strip()
+        elif self.is_in_final_answer and any(re.search(p, line) for p in AGENT_LOG_PATTERNS_TO_SKIP):
+            self.is_in_final_answer = False
+        if self.is_in_final_answer:
+            # 最終回答が複数行にわたる場合は，まとめて 1 回で喋る
+            if line != "":
+                self.final_answer_lines.append(line)
+            return
+        self.num_lines_skipped += 1
+        if self.num_lines_skipped == 1 and self.thinking_cue is not None:
+            self._speak(self.thinking_cue)
+
+    def flush(self) -> Optional[str]:
+        """
+        問い合わせの終了時に呼び出す．最終回答を喋り，その内容を返す（無ければ None）．
+        """
+        final_answer = self.final_answer
+        if final_answer is not None:
+            self._speak(final_answer)
+        elif self.fallback_answer is not None:
+            self._speak(self.fallback_answer)
+        return final_answer
+
+    @property
+    def final_answer(self) -> Optional[str]:
+        if len(self.final_answer_lines) == 0:
+            return None
+        return " ".join(self.final_answer_lines)[:self.max_chars]
+
+    def _speak(self, text: str):
+        if self.num_utterances >= self.max_utterances:
+            return
+        self.num_utterances += 1
+        self.fn_speak(text[:self.max_chars])
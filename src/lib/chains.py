@@ -1,40 +1,95 @@
-import asyncio
 import re
-from typing import List, Optional, Dict, cast
+import threading
+from typing import Callable, List, Optional, Dict, Tuple, cast
 
 from langchain import LLMChain, OpenAI, ConversationChain, PromptTemplate
 from langchain.chains.conversation.memory import ConversationSummaryMemory
 from langchain.prompts.base import BaseOutputParser
 
+from lib.llm_client import llm_client
 from lib.utils import pick_first_row, random_choice, remove_linebreaks
 
 
+def cleanse_streamer_output(output: str) -> str:
+    """
+    配信者の発話から，改行や括弧などの余分な部分を取り除く．
+    """
+    return remove_linebreaks(pick_first_row(output.strip())).strip() \
+        .removeprefix("「") \
+        .removesuffix("」") \
+        .removeprefix("\"") \
+        .removesuffix("\"") \
+        .removeprefix("'") \
+        .removesuffix("'")
+
+
+def extract_query_to_google_home(text: str) -> Optional[str]:
+    """
+    配信者の発話から，Google Home に対しての質問文を抽出する．
+    """
+    query_to_google_home: Optional[str] = None
+    _ = re.search(r"OK Google[,，、](.+?($|[?？!！。]))", text)
+    if _ is not None:
+        query_to_google_home = _.groups()[0].strip()
+        if query_to_google_home is not None and len(query_to_google_home) > 40:  # 長すぎる場合は抽出失敗してそうなので
+            query_to_google_home = None
+    return query_to_google_home
+
+
 class OutputParserForConversation(BaseOutputParser):
     """
     配信者用の chain からの出力をパースする．
     """
     def parse(self, output: str) -> Dict[str, Optional[str]]:  # type: ignore
         # NOTE: BaseOutputParser では Return value は Dict[str, str] だが，ここでは Optional[str] にしている．
-        output_cleansed = remove_linebreaks(pick_first_row(output.strip())).strip() \
-            .removeprefix("「") \
-            .removesuffix("」") \
-            .removeprefix("\"") \
-            .removesuffix("\"") \
-            .removeprefix("'") \
-            .removesuffix("'")
-        query_to_google_home: Optional[str] = None
-        _ = re.search(r"OK Google[,，、](.+?($|[?？!！。]))", output_cleansed)
-        if _ is not None:
-            query_to_google_home = _.groups()[0].strip()
-            if query_to_google_home is not None and len(query_to_google_home) > 40:  # 長すぎる場合は抽出失敗してそうなので
-                query_to_google_home = None
-
+        output_cleansed = cleanse_streamer_output(output)
         return {
             "text": output_cleansed,
-            "query_to_google_home": query_to_google_home
+            "query_to_google_home": extract_query_to_google_home(output_cleansed)
         }
 
 
+class OutputParserForMultipleReplies(BaseOutputParser):
+    """
+    配信者用の chain（複数返答版）からの出力をパースする．
+    "@視聴者名: 返答" の形式の行を，上から順に最大 max_replies 件取り出す．返答先の視聴者名は "to" に入れる．
+    """
+    def __init__(self, max_replies: int = 3, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_replies = max_replies
+
+    def parse(self, output: str) -> List[Dict[str, Optional[str]]]:  # type: ignore
+        replies: List[Dict[str, Optional[str]]] = []
+        for row in output.strip().split("\n"):
+            _ = re.match(r"^\s*@([^:：]*)[:：](.*)$", row)
+            if _ is None:
+                continue
+            text = cleanse_streamer_output(_.groups()[1])
+            if text == "":
+                continue
+            replies.append({
+                "text": text,
+                "query_to_google_home": extract_query_to_google_home(text),
+                "to": _.groups()[0].strip() or None
+            })
+            if len(replies) >= self.max_replies:
+                break
+        return replies
+
+
+# 配信者のキャラ設定
+STREAMER_CHARACTERS = "The Streamer has the following characters:\n- You are cute and fancy female cat.\n- Your name is \"タマ\" and you call yourself \"わたし\".\n- You have Google Home, and when audiences chat hard questions, you like to ask it about that questions, with saying \"OK Google\".\n- You are talkative and provides lots of specific details from its context.\n- You use at least 10 emojis in each reply."
+
+
+# LLM が使えない間に配信者が話す，つなぎの台詞
+STREAMER_FILLER_LINES = [
+    "ちょっとお水飲んでくるね〜🥤😺💦",
+    "あれれ、なんだか頭がぼーっとする…😵💫🐱",
+    "みんな、チャットどんどん書いてね〜💬😸✨",
+    "ふわぁ〜、ちょっと眠くなってきちゃった😪🐾💤",
+]
+
+
 # 配信者用の chain
 streamer_chain = ConversationChain(
     llm=OpenAI(
@@ -52,13 +107,132 @@ streamer_chain = ConversationChain(
     ),
     verbose=True,
     prompt=PromptTemplate(
-        template="I want you to act as a YouTube Streamer. Audiences write in the chat, and you will reply to all of them **in Japanese**. The reply should be no more than 80 letters. The Streamer has the following characters:\n- You are cute and fancy female cat.\n- Your name is \"タマ\" and you call yourself \"わたし\".\n- You have Google Home, and when audiences chat hard questions, you like to ask it about that questions, with saying \"OK Google\".\n- You are talkative and provides lots of specific details from its context.\n- You use at least 10 emojis in each reply.\n\nCurrent conversation:\n{history}\n{input}Streamer (You):",
+        template="I want you to act as a YouTube Streamer. Audiences write in the chat, and you will reply to all of them **in Japanese**. The reply should be no more than 80 letters. " + STREAMER_CHARACTERS + "\n\nCurrent conversation:\n{history}\n{input}Streamer (You):",
         input_variables=["history", "input"],
         output_parser=OutputParserForConversation()
     )  # NOTE: 状況設定用プロンプト
 )
 
 
+# 配信者用の chain（複数の視聴者に一度に返答する版）．メモリーは streamer_chain と共有する．
+streamer_multi_chain = ConversationChain(
+    llm=OpenAI(
+        stop=["\nAudience"],
+        temperature=0.7,
+        frequency_penalty=1.0,
+        presence_penalty=1.0
+    ),  # stop は「視聴者の発言の予測」を切り落とすため
+    memory=streamer_chain.memory,
+    verbose=True,
+    prompt=PromptTemplate(
+        template="I want you to act as a YouTube Streamer. Audiences write in the chat, and you will reply to several of them at once **in Japanese**. Write at most 3 replies, one per line, in the form \"@<audience name>: <reply>\", and call the audience by name in each reply. Each reply should be no more than 60 letters. " + STREAMER_CHARACTERS + "\n\nCurrent conversation:\n{history}\n{input}Streamer (You):\n",
+        input_variables=["history", "input"],
+        output_parser=OutputParserForMultipleReplies(max_replies=3)
+    )  # NOTE: 状況設定用プロンプト
+)
+
+
+# 会話の要約の更新を 1 つずつ行うためのロック
+streamer_memory_lock = threading.Lock()
+
+
+def summarize_turn(summary: str, input: str, output: str) -> str:
+    """
+    会話の要約に 1 ターン分のやりとりを加えた，新しい要約を返す（ConversationSummaryMemory.save_context と同じ処理だが，メモリーは更新しない）．
+    """
+    memory = cast(ConversationSummaryMemory, streamer_chain.memory)
+    return LLMChain(llm=memory.llm, prompt=memory.prompt).predict(summary=summary, new_lines=f"Human: {input}\nAI: {output}")
+
+
+def commit_turn(input: str, output: str) -> None:
+    """
+    1 ターン分のやりとりを会話の要約に反映する．
+    要約の計算は副作用が無いので，リトライやタイムアウトで打ち切られても安全で，採用した結果のみをメモリーに代入する．
+    """
+    memory = cast(ConversationSummaryMemory, streamer_chain.memory)
+    with streamer_memory_lock:
+        memory.buffer = llm_client.call(summarize_turn, memory.buffer, input, output, hedge=False)
+
+
+def stream_first_row(llm: OpenAI, prompt: str) -> str:
+    """
+    LLM の出力をストリーミングで受け取り，最初の（空でない）行が完成した時点で生成を打ち切る．
+    先頭に改行が出力される問題があるため，先頭の空白や改行は読み飛ばす．
+    """
+    buffer = ""
+    response = llm.client.create(model=llm.model_name, prompt=prompt, stream=True, **llm._default_params)
+    try:
+        for chunk in response:
+            buffer += chunk["choices"][0].get("text", "")
+            if "\n" in buffer.lstrip():
+                break
+    finally:
+        # 生成の途中で読むのをやめる（接続を閉じて，残りの生成を打ち切る）
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+    return pick_first_row(buffer.lstrip())
+
+
+def build_streamer_inputs(input: str, context: str = "") -> Dict[str, str]:
+    """
+    配信者用の chain への入力（レポートと会話の要約）を作る．
+    context を指定した場合，「関連する過去のやりとり」として会話の要約の後ろに挿入する．
+    """
+    memory = streamer_chain.memory
+    assert memory is not None
+    inputs = dict({"input": input}, **memory.load_memory_variables({"input": input}))
+    if context != "":
+        inputs[memory.memory_variables[0]] += f"\n\nRelated past conversation:\n{context}"
+    return inputs
+
+
+def predict_streamer_without_memory(
+    input: str,
+    streaming: bool = False,
+    context: str = ""
+) -> Tuple[Dict[str, Optional[str]], Callable[[], None]]:
+    """
+    streamer_chain を，メモリーを更新せずに実行する（投機的な生成用）．
+    パース済みの出力と，メモリーを更新するための関数の組を返す．
+    streaming が True の場合，最初の行が完成した時点で生成を打ち切る（メモリーにも最初の行のみが反映される）．
+    context を指定した場合，「関連する過去のやりとり」として会話の要約の後ろに挿入する（メモリーには反映しない）．
+    """
+    inputs_for_prompt = build_streamer_inputs(input, context=context)
+    if streaming:
+        prompt = streamer_chain.prompt.format(**{k: inputs_for_prompt[k] for k in streamer_chain.prompt.input_variables})
+        outputs = {streamer_chain.output_key: stream_first_row(cast(OpenAI, streamer_chain.llm), prompt)}
+    else:
+        outputs = streamer_chain._call(inputs_for_prompt)
+    output_parser = streamer_chain.prompt.output_parser
+    assert output_parser is not None
+    pred = cast(Dict[str, Optional[str]], output_parser.parse(outputs[streamer_chain.output_key]))
+
+    def _fn_commit() -> None:
+        commit_turn(input, outputs[streamer_chain.output_key])
+
+    return pred, _fn_commit
+
+
+def predict_streamer_multi_without_memory(
+    input: str,
+    context: str = ""
+) -> Tuple[List[Dict[str, Optional[str]]], Callable[[], None]]:
+    """
+    streamer_multi_chain を，メモリーを更新せずに実行する．
+    パース済みの出力（返答のリスト）と，メモリーを更新するための関数の組を返す．パースに失敗した返答を使わない場合は，メモリーを更新しないこと．
+    """
+    outputs = streamer_multi_chain._call(build_streamer_inputs(input, context=context))
+    output_parser = streamer_multi_chain.prompt.output_parser
+    assert output_parser is not None
+    preds = cast(List[Dict[str, Optional[str]]], output_parser.parse(outputs[streamer_multi_chain.output_key]))
+
+    def _fn_commit() -> None:
+        commit_turn(input, outputs[streamer_multi_chain.output_key])
+
+    return preds, _fn_commit
+
+
 # chain の出力が何かを列挙する感じのものである場合に，それをパースするためのクラス
 class OutputParserForListedAnswers(BaseOutputParser):
     def __init__(self, regex, *args, **kwargs):
@@ -131,10 +305,9 @@ class CMGenerator(TVGenerator):
 
     async def generate(self) -> str:
         category = random_choice(self.categories)
-        genres = cast(List[str], concretizer_chain.predict_and_parse(category=category))
-        await asyncio.sleep(0.1)
+        genres = cast(List[str], await llm_client.call_async(concretizer_chain.predict_and_parse, category=category))
         genre = random_choice(genres)
-        cm = cm_chain.predict(genre=genre)
+        cm = await llm_client.call_async(cm_chain.predict, genre=genre)
         return cm
 
 
@@ -145,8 +318,7 @@ class NewsGenerator(TVGenerator):
 
     async def generate(self) -> str:
         category = random_choice(self.categories)
-        genres = cast(List[str], concretizer_chain.predict_and_parse(category=category))
-        await asyncio.sleep(0.1)
+        genres = cast(List[str], await llm_client.call_async(concretizer_chain.predict_and_parse, category=category))
         genre = random_choice(genres)
-        cm = news_chain.predict(genre=genre)
+        cm = await llm_client.call_async(news_chain.predict, genre=genre)
         return cm
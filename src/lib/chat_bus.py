@@ -0,0 +1,147 @@
+"""
+チャットバス
+YouTube Live・WebSocket・リプレイファイルなど複数の送り手からのチャットを，固定長のリングバッファにまとめます．
+溢れた場合は古いものから捨てるため，チャットが殺到してもメモリー使用量は一定です．
+"""
+import asyncio
+import itertools
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from lib.quota import QuotaGovernor, QuotaLevelEnum
+from lib.utils import get_error_message
+from lib.youtube import QUOTA_COST_GET_CHAT, ChatLog, ChatMonitor
+
+
+class ChatCursor:
+    """
+    チャットバスの読み手ごとの読み出し位置
+    """
+    def __init__(self, position: int):
+        self.position = position
+        self.num_dropped = 0  # 読む前に上書きされた（または読み飛ばした）チャットの件数
+
+
+class ChatBus:
+    def __init__(self, capacity: int = 1000):
+        """
+        固定長のリングバッファによるチャットバス．
+        書き込みはロックを取らない（採番に itertools.count を使い，スロットへの代入のみ行う．いずれも GIL の下でアトミック）．
+        ----
+        Args:
+            capacity: 保持するチャットの最大件数．
+        """
+        self.capacity = capacity
+        self.slots: List[Optional[Tuple[int, ChatLog]]] = [None] * capacity
+        self.counter = itertools.count()
+        self.num_pushed = 0
+        self.num_pushed_by_source: Dict[str, int] = {}
+
+    def push(self, chat: ChatLog):
+        """
+        チャットを書き込む．時刻が無い場合は現在時刻を付与する．
+        """
+        if chat.time is None:
+            chat.time = time.time()
+        seq = next(self.counter)
+        self.slots[seq % self.capacity] = (seq, chat)
+        self.num_pushed = max(self.num_pushed, seq + 1)
+        self.num_pushed_by_source[chat.source] = self.num_pushed_by_source.get(chat.source, 0) + 1
+
+    def cursor(self, from_latest: bool = True) -> ChatCursor:
+        """
+        読み手を作成する．from_latest が True の場合は，これから書き込まれるチャットのみを読む．
+        """
+        return ChatCursor(self.num_pushed if from_latest else max(0, self.num_pushed - self.capacity))
+
+    def peek(self, cursor: ChatCursor, max_items: Optional[int] = None) -> List[ChatLog]:
+        """
+        read と同じチャットを返すが，読み出し位置は進めない．
+        """
+        return self.read(ChatCursor(cursor.position), max_items=max_items)
+
+    def read(self, cursor: ChatCursor, max_items: Optional[int] = None) -> List[ChatLog]:
+        """
+        前回読んだ位置からのチャットを返す．max_items を超える場合は，新しいものを残して古いものを読み飛ばす．
+        """
+        end = self.num_pushed
+        oldest = end - self.capacity
+        if cursor.position < oldest:
+            # 読む前に上書きされた
+            cursor.num_dropped += oldest - cursor.position
+            cursor.position = oldest
+        if max_items is not None and end - cursor.position > max_items:
+            cursor.num_dropped += end - cursor.position - max_items
+            cursor.position = end - max_items
+        chats: List[ChatLog] = []
+        while cursor.position < end:
+            slot = self.slots[cursor.position % self.capacity]
+            if slot is None or slot[0] < cursor.position:
+                # 採番済みだが，まだ書き込まれていない
+                break
+            if slot[0] > cursor.position:
+                cursor.num_dropped += 1
+            else:
+                chats.append(slot[1])
+            cursor.position += 1
+        return chats
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "capacity": self.capacity,
+            "num_pushed": self.num_pushed,
+            "num_overflowed": max(0, self.num_pushed - self.capacity),
+            **{f"num_pushed_{source}": n for source, n in self.num_pushed_by_source.items()}
+        }
+
+
+# 節約の段階ごとの，YouTube Live のチャット取得間隔の倍率
+YOUTUBE_POLLING_INTERVAL_FACTORS = {
+    QuotaLevelEnum.NORMAL: 1.0,
+    QuotaLevelEnum.SAVING: 2.0,
+    QuotaLevelEnum.CRITICAL: 4.0,
+    QuotaLevelEnum.EXHAUSTED: 12.0,
+}
+
+
+async def poll_youtube(
+    bus: ChatBus,
+    chat_monitor: ChatMonitor,
+    interval_sec: float = 10.0,
+    quota_governor: Optional[QuotaGovernor] = None
+):
+    """
+    YouTube Live のチャットを定期的に取得してバスに流す（取得はイベントループを止めないよう別スレッドで行う）．
+    取得間隔は interval_sec と，API が指定する待ち時間（pollingIntervalMillis）の長い方とする．
+    quota_governor を指定した場合，利用枠が少なくなるほど取得間隔を延ばし，枠が残っていない間は取得しない．
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        level = quota_governor.level("youtube") if quota_governor is not None else QuotaLevelEnum.NORMAL
+        try:
+            if quota_governor is None or quota_governor.allows("youtube", QUOTA_COST_GET_CHAT, max_level=QuotaLevelEnum.CRITICAL):
+                for chat in await loop.run_in_executor(None, chat_monitor.get_recent_chats):
+                    bus.push(chat)
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+        polling_interval_sec = max(interval_sec, getattr(chat_monitor, "polling_interval_sec", None) or 0.0)
+        await asyncio.sleep(polling_interval_sec * YOUTUBE_POLLING_INTERVAL_FACTORS[level])
+
+
+async def replay_chats(bus: ChatBus, path: Union[str, Path], speed: float = 1.0):
+    """
+    jsonl 形式のチャットファイルを再生してバスに流す．
+    各行は {"name": "...", "message": "...", "offset_sec": 12.3} の形式で，offset_sec は再生開始からの秒数．
+    """
+    t0 = asyncio.get_running_loop().time()
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip() != ""]
+    for row in sorted(rows, key=lambda r: r.get("offset_sec", 0.0)):
+        wait_sec = t0 + row.get("offset_sec", 0.0) / speed - asyncio.get_running_loop().time()
+        if wait_sec > 0:
+            await asyncio.sleep(wait_sec)
+        bus.push(ChatLog(name=row.get("name", ""), message=row["message"], source="replay"))
@@ -1,14 +1,18 @@
 import asyncio
+import functools
 import json
 import sys
 import time
-from typing import Awaitable, Callable, List, Optional, Tuple
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 
 import numpy as np
 from pydantic import BaseModel, Field
 
 from agent import FnSmartAgent
-from lib.tts.tts import SpeechModeEnum, speak
+from lib.agent_output import AgentOutputAggregator
+from lib.quota import QuotaGovernor
+from lib.tts.tts import FnPlay, FnSynthesize, SpeechModeEnum, play, synthesize_async
 from lib.utils import WordInfo, build_time_expression, count_mora, get_error_message, mecab_parser, remove_emojis, remove_linebreaks
 from lib.youtube import ChatLog
 from lib.emotes import determine_emote_from_text
@@ -21,6 +25,7 @@ class Action(BaseModel):
     text: str = Field(..., description="発話するテキスト")
     query_to_google_home: Optional[str] = Field(None, description="Google Home に対しての質問文（あれば）")
     by: Optional[str] = Field(None, description="発話者")
+    to: Optional[str] = Field(None, description="返答先の視聴者名（複数の視聴者に一度に返答した場合）")
 
 
 class GPTuber:
@@ -31,13 +36,20 @@ class GPTuber:
         fn_distract: Optional[Callable[[], Awaitable[str]]] = None,
         fn_send_message: Optional[Callable[[str], None]] = None,
         fn_smart_agent: Optional[FnSmartAgent] = None,
-        no_neural_tts: bool = False
+        no_neural_tts: bool = False,
+        fn_streamer_llm_speculative: Optional[Callable[[str], Tuple[Action, Callable[[], None]]]] = None,
+        fn_streamer_llm_multi: Optional[Callable[[str], List[Action]]] = None,
+        fn_time: Callable[[], float] = time.time,
+        fn_synthesize: FnSynthesize = synthesize_async,
+        fn_play: FnPlay = play,
+        quota_governor: Optional[QuotaGovernor] = None
     ):
         """
         「配信者」のクラス
         ----
         Args:
             fn_streamer_llm: 大規模言語モデルを用いた，YouTuberの行動を生成する関数．この関数は「直近の出来事を表すレポート」を引数にとり，行動を返す必要がある．
+                イベントループを止めないよう，別スレッドで呼び出される（fn_streamer_llm_multi, fn_streamer_llm_speculative も同様）．
                 直近の出来事を表すレポートは，基本的に以下のようなフォーマットである．
                 ```
                 Audience: こんにちは
@@ -63,6 +75,16 @@ class GPTuber:
                 ログ内容およびログ回数は任意であるが，Google Home からの最終返答を YouTuber にフィードバックするには，"Final Answer: " という文字列を含むログ内容を
                 一度コールバックする必要がある．
             no_neural_tts: True の場合，Neural TTS を使用せず，標準の TTS を使用する（品質は下がる）．      
+            fn_streamer_llm_speculative: 投機的に次の行動を生成するための関数．指定した場合，配信者が喋っている間に次の行動を先に生成しておく．
+                fn_streamer_llm と同じくレポートを引数にとるが，メモリーは更新せずに，行動と「メモリーを更新する関数」の組を返す必要がある．
+                生成中に新しいチャットが来た場合，生成結果は破棄され，メモリーも更新されない．
+                複数返答や TV の割り込みが必要な場合は投機せず，通常通り fn_streamer_llm_multi などで生成する．
+            fn_streamer_llm_multi: 複数の視聴者に一度に返答するための関数．指定した場合，チャットが multi_reply_min_chats 件以上あれば，こちらが使われる．
+                レポートの Audience の行には視聴者名が付与される（例: `Audience (視聴者名): こんにちは`）．返り値の行動は，順に予約される．
+            fn_time: 現在時刻（UNIX 時間）を返す関数．シミュレーション時は仮想時刻を返す関数に差し替える．
+            fn_synthesize: テキストの音声を合成する関数．引数は lib.tts.tts.synthesize_async と同じ．シミュレーション時は実際には合成しない関数に差し替える．
+            fn_play: 合成した音声を再生する関数．引数は lib.tts.tts.play と同じで，再生し終わったら callback を呼び出す必要がある．シミュレーション時は実際には再生しない関数に差し替える．
+            quota_governor: 外部 API の利用枠．指定した場合，枠が少なくなると Neural TTS を使わずに喋り，Google Home はキャッシュからのみ答える．
         """
         self.fn_streamer_llm = fn_streamer_llm
         self.fn_get_recent_chats = fn_get_recent_chats
@@ -70,63 +92,136 @@ class GPTuber:
         self.fn_send_message = fn_send_message
         self.fn_smart_agent = fn_smart_agent
         self.no_neural_tts = no_neural_tts
+        self.fn_time = fn_time
+        self.fn_synthesize = fn_synthesize
+        self.fn_play = fn_play
+        self.startup_wait_sec = 5.0
         self.main_loop_wait_sec = 10.0
+        self.main_loop2_wait_sec = 1.0
         self.actions_reserved: List[Action] = []
         self.is_now_acting: bool = False
-        self.last_chat_time: float = time.time()
-        self.last_non_boring_time: float = time.time()
+        self.acting_id = 0  # 現在の行動の ID（行動ごとに増える）
+        self.playback_end_time = 0.0  # 再生中の音声の再生終了時刻（不明な場合は過去の時刻）
+        self.gapless_lead_sec = 1.0  # 再生終了の何秒前に次の行動（音声合成）を始めるか
+        self.last_chat_time: float = self.fn_time()
+        self.last_non_boring_time: float = self.fn_time()
         self.boring_patience_sec = 120.0
         self.final_answer_from_google_home: Optional[str] = None
+        self.chat_logs_pending: List[ChatLog] = []
+        self.fn_streamer_llm_speculative = fn_streamer_llm_speculative
+        self.speculation: Optional[asyncio.Task] = None
+        self.speculation_commit: Optional[asyncio.Task] = None  # 確定した投機のメモリー更新
+        self.speculation_window: Deque[bool] = deque(maxlen=10)  # 直近の投機の結果（True は無駄になったもの）
+        self.speculation_max_wasted = 5  # 直近の投機のうち，無駄になってよい回数の上限
+        self.speculation_stats: Dict[str, int] = {"started": 0, "committed": 0, "discarded": 0, "skipped": 0, "deferred": 0}
+        self.fn_streamer_llm_multi = fn_streamer_llm_multi
+        self.multi_reply_min_chats = 2
+        self.agent_max_utterances = 2  # 1 回の Google Home への問い合わせで，Google Home が喋る回数の上限
+        self.quota_governor = quota_governor
+        self.google_home_cache: Dict[str, str] = OrderedDict()  # 質問 -> Google Home の答え（新しいものが後ろ）
+        self.google_home_cache_size = 100
+        self.google_home_unavailable_answer = "Sorry, I can't search the web right now."
 
     async def main_loop(self):
         """
         行動生成のためのメインループ
         """
-        await asyncio.sleep(5)
+        await asyncio.sleep(self.startup_wait_sec)
         while True:
-            if len(self.actions_reserved) < 3:
-                current_time = time.time()
+            # 投機的な生成が進行中の場合は，その結果を待つ
+            if len(self.actions_reserved) < 3 and self.speculation is None:
+                current_time = self.fn_time()
                 # 最新のコメントを取得
-                new_chat_logs = self.fn_get_recent_chats() if self.fn_get_recent_chats is not None else []
+                self.collect_recent_chats()
+                new_chat_logs = self.chat_logs_pending
+                self.chat_logs_pending = []
+                # チャットが多い場合は，複数の視聴者に一度に返答する
+                is_multi = self.is_busy(new_chat_logs)
                 # レポート（直近の動き）を作成
-                if len(new_chat_logs) > 0:
-                    report = "".join(
-                        [f"Audience: {remove_linebreaks(log.message)[:256]}" + "\n" for log in new_chat_logs]
-                    )
-                    self.last_chat_time = current_time
+                final_answer = self.final_answer_from_google_home
+                report = self.build_report(new_chat_logs, current_time, with_names=is_multi)
+                # 暇時間が一定に達した場合，TVの情報が割り込む
+                if self.fn_distract is not None and self.is_bored(new_chat_logs, current_time):
+                    report += f"(TV: 「...{remove_linebreaks(await self.fn_distract())}」)" + "\n"
                     self.last_non_boring_time = current_time
-                else:
-                    elapsed_sec = current_time - self.last_chat_time
-                    report = f"(視聴者のチャットが無く{build_time_expression(elapsed_sec)}経過)" + "\n"
-                    # 暇時間が一定に達した場合，TVの情報が割り込む
-                    if self.fn_distract is not None and current_time - self.last_non_boring_time > self.boring_patience_sec:
-                        report += f"(TV: 「...{remove_linebreaks(await self.fn_distract())}」)" + "\n"
-                        self.last_non_boring_time = current_time
-                    # Google Home が答えを返してきた場合，その情報が割り込む
-                    if self.final_answer_from_google_home is not None:
-                        report += f"(Google Home の答え: {remove_linebreaks(self.final_answer_from_google_home)})" + "\n"
-                        self.final_answer_from_google_home = None
+                self.on_report_consumed(new_chat_logs, current_time, final_answer)
+                # 直前の投機の確定分が，会話の要約に反映されるのを待つ
+                await self.wait_for_speculation_commit()
                 try:
-                    # LLM に聞く（メモリー付きのChainの場合は，内部的にメモリーも更新される）
-                    action = self.fn_streamer_llm(report)
-                    print(f"{action=}")
-                    action.by = "streamer"
-                    # 行動の予約
-                    self.reserve_action(action)
+                    # LLM に聞く（メモリー付きのChainの場合は，内部的にメモリーも更新される）．
+                    # リトライ等で時間がかかっても他の処理（行動の消化，字幕の送信など）を止めないよう，別スレッドで実行する．
+                    loop = asyncio.get_running_loop()
+                    actions = await loop.run_in_executor(None, self.fn_streamer_llm_multi, report) \
+                        if is_multi and self.fn_streamer_llm_multi is not None else []
+                    if len(actions) == 0:
+                        # 複数返答のパースに失敗した場合も，通常の返答にフォールバックする
+                        actions = [await loop.run_in_executor(None, self.fn_streamer_llm, report)]
+                    for action in actions:
+                        print(f"{action=}")
+                        action.by = "streamer"
+                        # 行動の予約
+                        self.reserve_action(action)
                 except Exception:
                     # 503 が多分多い
                     print(get_error_message(), file=sys.stderr)
             # 待機
             await asyncio.sleep(self.main_loop_wait_sec)
 
+    def is_busy(self, chat_logs: List[ChatLog]) -> bool:
+        """
+        チャットが多く，複数の視聴者に一度に返答すべき状態かどうか．
+        """
+        return self.fn_streamer_llm_multi is not None and len(chat_logs) >= self.multi_reply_min_chats
+
+    def is_bored(self, chat_logs: List[ChatLog], current_time: float) -> bool:
+        """
+        チャットが無い時間が一定に達し，TV の情報を割り込ませるべき状態かどうか．
+        """
+        return len(chat_logs) == 0 and current_time - self.last_non_boring_time > self.boring_patience_sec
+
+    def collect_recent_chats(self) -> int:
+        """
+        最新のチャットを取得して，未消化のチャットに追加する．追加した件数を返す．
+        """
+        new_chat_logs = self.fn_get_recent_chats() if self.fn_get_recent_chats is not None else []
+        self.chat_logs_pending += new_chat_logs
+        return len(new_chat_logs)
+
+    def build_report(self, chat_logs: List[ChatLog], current_time: float, with_names: bool = False) -> str:
+        """
+        レポート（直近の動き）を作成する．TV の割り込みは含まない．状態は変更しない．
+        with_names が True の場合，Audience の行に視聴者名を付与する．
+        """
+        if len(chat_logs) > 0:
+            return "".join(
+                [f"Audience{f' ({log.name})' if with_names and log.name != '' else ''}: {remove_linebreaks(log.message)[:256]}" + "\n" for log in chat_logs]
+            )
+        elapsed_sec = current_time - self.last_chat_time
+        report = f"(視聴者のチャットが無く{build_time_expression(elapsed_sec)}経過)" + "\n"
+        # Google Home が答えを返してきた場合，その情報が割り込む
+        if self.final_answer_from_google_home is not None:
+            report += f"(Google Home の答え: {remove_linebreaks(self.final_answer_from_google_home)})" + "\n"
+        return report
+
+    def on_report_consumed(self, chat_logs: List[ChatLog], current_time: float, final_answer_reported: Optional[str] = None):
+        """
+        build_report で作成したレポートが LLM に渡された時に，状態を更新する．
+        final_answer_reported はレポート作成時点の Google Home の答えで，レポートに含まれていた場合のみ消化済みにする．
+        """
+        if len(chat_logs) > 0:
+            self.last_chat_time = current_time
+            self.last_non_boring_time = current_time
+        elif final_answer_reported is not None and final_answer_reported == self.final_answer_from_google_home:
+            self.final_answer_from_google_home = None
+
     async def main_loop2(self):
         """
         行動消化のためのメインループ
         """
-        await asyncio.sleep(5)
+        await asyncio.sleep(self.startup_wait_sec)
         while True:
             self.check_acting_and_act()
-            await asyncio.sleep(1)
+            await asyncio.sleep(self.main_loop2_wait_sec)
 
     def reserve_action(self, action: Action):
         """
@@ -140,6 +235,8 @@ class GPTuber:
         行動中でなければ，予約された行動を実行する．
         """
         if not self.is_now_acting:
+            if self.speculation is not None and self.speculation.done() and len(self.actions_reserved) == 0:
+                self.resolve_speculation()
             if len(self.actions_reserved) > 0:
                 # a = self.actions_reserved.pop(0)
                 # 先頭を取り出すが，agent の行動がある場合は優先して取り出したほうが良さそう．
@@ -150,61 +247,168 @@ class GPTuber:
                     a = self.actions_reserved.pop(0)
                 self.act_now(a)
 
-    def on_finish_action(self):
+    def on_finish_action(self, acting_id: Optional[int] = None):
         """
         行動終了時に呼び出される関数．呼び出される設定は行動開始時になされる．
+        acting_id が指定された場合，それが現在の行動でなければ（既に次の行動に移っていれば）何もしない．
         """
-        self.is_now_acting = False
+        if acting_id is None or acting_id == self.acting_id:
+            self.is_now_acting = False
 
     def act_now(self, action: Action):
         """
         直ちに行動を実行する．
         """
         self.is_now_acting = True
+        self.acting_id += 1
         if action.by == "streamer":
             # if action.emote is not None:
             #     asyncio.create_task(self.emote_now(action.emote))
             if action.text is not None:
-                asyncio.create_task(self.speak_now(action.text, by=action.by))
+                asyncio.create_task(self.speak_now(action.text, by=action.by, acting_id=self.acting_id))
             if action.query_to_google_home is not None:
                 asyncio.create_task(self.query_to_google_home_now(action.query_to_google_home))
+            self.start_speculation()
         elif action.by == "agent":
             if action.text is not None:
-                asyncio.create_task(self.speak_now(action.text, by=action.by))
+                asyncio.create_task(self.speak_now(action.text, by=action.by, acting_id=self.acting_id))
+
+    def start_speculation(self):
+        """
+        喋っている間に，次の行動を投機的に生成し始める．
+        """
+        if self.fn_streamer_llm_speculative is None or self.speculation is not None or len(self.actions_reserved) > 0:
+            return
+        if sum(self.speculation_window) >= self.speculation_max_wasted:
+            # 無駄打ちが多いので，しばらく投機しない（窓を進めるため，投機しなかったことも記録する）
+            self.speculation_window.append(False)
+            self.speculation_stats["skipped"] += 1
+            return
+        self.collect_recent_chats()
+        if self.is_busy(self.chat_logs_pending) or (self.fn_distract is not None and self.is_bored(self.chat_logs_pending, self.fn_time())):
+            # 複数返答や TV の割り込みは投機の対象外なので，メインループに任せる
+            self.speculation_stats["deferred"] += 1
+            return
+        self.speculation_stats["started"] += 1
+        self.speculation = asyncio.create_task(self.speculate())
+
+    async def speculate(self) -> Tuple[int, float, Optional[str], Action, Callable[[], None]]:
+        """
+        その時点までのチャットから，次の行動を生成する．
+        返り値は (使用したチャット件数, レポート作成時刻, レポート作成時点の Google Home の答え, 行動, メモリーを更新する関数)．
+        """
+        assert self.fn_streamer_llm_speculative is not None
+        # 直前の投機の確定分が，会話の要約に反映されるのを待つ（自分の直前の発言を踏まえるため）
+        await self.wait_for_speculation_commit()
+        current_time = self.fn_time()
+        self.collect_recent_chats()
+        num_chats = len(self.chat_logs_pending)
+        final_answer = self.final_answer_from_google_home
+        report = self.build_report(self.chat_logs_pending, current_time)
+        loop = asyncio.get_running_loop()
+        action, fn_commit = await loop.run_in_executor(None, self.fn_streamer_llm_speculative, report)
+        return num_chats, current_time, final_answer, action, fn_commit
+
+    def resolve_speculation(self):
+        """
+        投機的に生成した行動を確定または破棄する．新しいチャットや Google Home の答えが来ていた場合は破棄する．
+        """
+        assert self.speculation is not None
+        speculation = self.speculation
+        self.speculation = None
+        try:
+            num_chats, report_time, final_answer, action, fn_commit = speculation.result()
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+            self.speculation_window.append(True)
+            self.speculation_stats["discarded"] += 1
+            return
+        self.collect_recent_chats()
+        if len(self.chat_logs_pending) > num_chats or self.final_answer_from_google_home != final_answer:
+            # 新しいチャットや答えが来たので破棄（未消化のまま残り，次の行動生成で使われる）
+            print(f"speculative {action=} is discarded.")
+            self.speculation_window.append(True)
+            self.speculation_stats["discarded"] += 1
+            return
+        chat_logs = self.chat_logs_pending
+        self.chat_logs_pending = []
+        self.on_report_consumed(chat_logs, report_time, final_answer)
+        # メモリーの更新（LLM の呼び出し）は，イベントループを止めないよう別スレッドで行う
+        self.speculation_commit = asyncio.create_task(self.commit_speculation(fn_commit))
+        print(f"speculative {action=} is committed.")
+        self.speculation_window.append(False)
+        self.speculation_stats["committed"] += 1
+        action.by = "streamer"
+        self.actions_reserved.append(action)
 
-    async def speak_now(self, text: str, by: str):
+    async def wait_for_speculation_commit(self):
+        if self.speculation_commit is not None:
+            await self.speculation_commit
+            self.speculation_commit = None
+
+    async def commit_speculation(self, fn_commit: Callable[[], None]):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, fn_commit)
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+
+    async def speak_now(self, text: str, by: str, acting_id: Optional[int] = None):
         """
-        直ちに喋る
+        直ちに喋る．音声の再生時間が分かる場合は，再生終了の少し前に行動を終了扱いにして，次の行動の音声合成を先に始めさせる．
+        次の行動の音声は，今の音声の再生終了を待ってから再生する．
         """
         if by == "streamer":
-            speak(
-                text,
-                mode=SpeechModeEnum.CLASSIC_JP if self.no_neural_tts else SpeechModeEnum.NEURAL_JP,
-                callback=self.on_finish_action
-            )
+            mode = SpeechModeEnum.CLASSIC_JP if self.no_neural_tts else SpeechModeEnum.NEURAL_JP
+            if mode is SpeechModeEnum.NEURAL_JP and self.quota_governor is not None and not self.quota_governor.allows("google_tts", len(text)):
+                # Neural TTS の利用枠が少ない場合は，標準の TTS で喋る
+                mode = SpeechModeEnum.CLASSIC_JP
         elif by == "agent":
-            speak(
-                text,
-                mode=SpeechModeEnum.CLASSIC_EN,
-                callback=self.on_finish_action
-            )
+            mode = SpeechModeEnum.CLASSIC_EN
         else:
             raise ValueError(f"Invalid by: {by}")
 
+        try:
+            audio = await self.fn_synthesize(text, mode)
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+            self.on_finish_action(acting_id)
+            return
+        # 前の音声の再生終了を待つ
+        wait_sec = self.playback_end_time - self.fn_time()
+        if wait_sec > 0:
+            await asyncio.sleep(wait_sec)
+        self.fn_play(audio, callback=functools.partial(self.on_finish_action, acting_id))
+        if audio.duration_sec is not None:
+            self.playback_end_time = self.fn_time() + audio.duration_sec
+            asyncio.get_running_loop().call_later(
+                max(0.0, audio.duration_sec - self.gapless_lead_sec),
+                self.on_almost_finish_action,
+                acting_id
+            )
+
         if self.fn_send_message is not None:
-            # 字幕の表示指示
+            # 字幕の表示指示（再生時間が分かる場合は，それに合わせる）
             timeline = generate_subtitle_timeline(
                 text,
                 flg_split=by == "streamer",
-                prefix="" if by == "streamer" else "(Google Home) "
+                prefix="" if by == "streamer" else "(Google Home) ",
+                duration_sec=audio.duration_sec
             )
             self.fn_send_message(
                 json.dumps({
                     "type": "subtitle",
+                    "id": audio.id,
                     "timeline": timeline
                 }, ensure_ascii=False)
             )
 
+    def on_almost_finish_action(self, acting_id: Optional[int] = None):
+        """
+        再生終了の少し前に呼び出される関数．行動を終了扱いにして，次の行動を始める．
+        """
+        self.on_finish_action(acting_id)
+        self.check_acting_and_act()
+
     async def emote_streamer_now(self, kind: str):
         """
         直ちに表情を変える（現在不使用）
@@ -220,27 +424,54 @@ class GPTuber:
     async def query_to_google_home_now(self, query: str):
         """
         直ちに Google Home に問い合わせる．実際には，追加のアクションを予約する．
+        検索の利用枠が少ない場合は，過去に同じ質問をした時の答えのみを返す（無ければ答えられない旨を返す）．
         """
-        def _fn_report(text: str):
-            text = text.strip()
-            if text != "":
-                self.reserve_action(Action(
-                    by="agent",
-                    text=text
-                ))
-                if "Final Answer: " in text:
-                    self.final_answer_from_google_home = text.split("Final Answer: ")[1]
+        cache_key = normalize_query(query)
+        if self.quota_governor is not None and not self.quota_governor.allows("serpapi"):
+            answer = self.google_home_cache.get(cache_key, self.google_home_unavailable_answer)
+            print(f"fn_smart_agent is skipped due to the quota. {query=}, {answer=}")
+            self.reserve_action(Action(by="agent", text=answer))
+            self.final_answer_from_google_home = answer
+            return
+
+        # ログ出力は集約して，「考え中」の合図と最終回答のみを喋る
+        aggregator = AgentOutputAggregator(
+            fn_speak=lambda text: self.reserve_action(Action(by="agent", text=text)),
+            max_utterances=self.agent_max_utterances
+        )
 
         if self.fn_smart_agent is not None:
             print(f"fn_smart_agent is started. {query=}")
-            await self.fn_smart_agent(query, fn_report=_fn_report)
+            await self.fn_smart_agent(query, fn_report=aggregator.feed)
+            final_answer = aggregator.flush()
+            if final_answer is not None:
+                self.final_answer_from_google_home = final_answer
+                self.cache_google_home_answer(cache_key, final_answer)
             print(f"fn_smart_agent is finished. {query=}")
 
 
+    def cache_google_home_answer(self, cache_key: str, answer: str):
+        """
+        Google Home の答えをキャッシュする．上限を超えた場合は古いものから捨てる．
+        """
+        self.google_home_cache.pop(cache_key, None)
+        self.google_home_cache[cache_key] = answer
+        while len(self.google_home_cache) > self.google_home_cache_size:
+            del self.google_home_cache[next(iter(self.google_home_cache))]
+
+
+def normalize_query(query: str) -> str:
+    """
+    Google Home への質問を，キャッシュのキーにするために正規化する．
+    """
+    return remove_linebreaks(query).strip().lower().rstrip("?？.。!！ ")
+
+
 def generate_subtitle_timeline(
     text: str,
     flg_split: bool = True,
-    prefix: str = ""
+    prefix: str = "",
+    duration_sec: Optional[float] = None
 ) -> List[Tuple[float, str, Optional[str]]]:
     """発話内容テキストから字幕表示指示を生成する．
     ----
@@ -248,6 +479,7 @@ def generate_subtitle_timeline(
         text (str): 発話内容テキスト
         flg_split (bool, optional): 文節ごとに字幕を表示するか． Defaults to True.
         prefix (str, optional): 全ての発話の先頭に付与する文字列（例えば，発話者を表す目的で使用可能である）． Defaults to "".
+        duration_sec (Optional[float], optional): 音声の再生時間．指定した場合，字幕の最後の時刻がこれに一致するよう，モーラあたりの秒数を合わせる． Defaults to None.
 
     Returns:
         List[Tuple[float, str, Optional[str]]]: (時刻(sec), 字幕表示内容, エモート変更指示) のリスト．
@@ -267,6 +499,9 @@ def generate_subtitle_timeline(
 
     # モーラカウントを適切な秒数に変換する
     coef = 0.14  # 1モーラあたりの秒数
+    total_mora_count = sum(chunk[0] for chunk in chunks)
+    if duration_sec is not None and total_mora_count > 0:
+        coef = duration_sec / total_mora_count
     timeline = list(zip(
         coef * np.cumsum([0] + [chunk[0] for chunk in chunks]),
         [remove_emojis(chunk[1], "") for chunk in chunks] + [""],  # 最後は字幕消す
@@ -0,0 +1,201 @@
+"""
+LLM 呼び出しの共通層
+タイムアウト，リトライ（指数バックオフ + ジッター），ヘッジ（遅い場合の重複リクエスト），サーキットブレーカーを提供します．
+"""
+import asyncio
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Set, TypeVar
+
+from lib.quota import QuotaLevelEnum, quota_governor
+from lib.utils import get_error_message
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    サーキットブレーカーが開いているため，呼び出しを行わなかったことを表す例外
+    """
+
+
+class QuotaExceededError(RuntimeError):
+    """
+    OpenAI の利用枠が残っていないため，呼び出しを行わなかったことを表す例外
+    """
+
+
+def is_retryable_error(e: BaseException) -> bool:
+    """
+    リトライすべきエラー（タイムアウト，レート制限，5xx）かどうかを判定する．
+    """
+    if isinstance(e, TimeoutError):
+        return True
+    # openai.error.OpenAIError は http_status を持つ（接続エラーの場合は None）
+    http_status = getattr(e, "http_status", None)
+    if http_status is not None:
+        return http_status == 429 or http_status >= 500
+    return type(e).__name__ in ["RateLimitError", "ServiceUnavailableError", "APIError", "APIConnectionError", "Timeout", "TryAgain"]
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 3, recovery_sec: float = 60.0):
+        """
+        連続して失敗した場合に，一定時間呼び出しを止めるためのクラス
+        ----
+        Args:
+            failure_threshold: この回数だけ連続して失敗すると，ブレーカーが開く．
+            recovery_sec: ブレーカーが開いてから，試しに呼び出しを再開する（半開状態にする）までの秒数．
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_sec = recovery_sec
+        self.num_failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.recovery_sec:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        with self.lock:
+            self.num_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.num_failures += 1
+            if self.num_failures >= self.failure_threshold:
+                # 半開状態で失敗した場合も，ここで開き直す
+                self.opened_at = time.time()
+
+
+class ResilientLLMClient:
+    def __init__(
+        self,
+        timeout_sec: float = 20.0,
+        max_retries: int = 2,
+        backoff_base_sec: float = 1.0,
+        backoff_max_sec: float = 8.0,
+        hedge_after_sec: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        max_workers: int = 8
+    ):
+        """
+        LLM を呼び出すためのクラス
+        ----
+        Args:
+            timeout_sec: 1 回の試行あたりの制限時間．超えた場合は打ち切り，リトライの対象とする．
+                （Python のスレッドは止められないため，打ち切られた呼び出しは裏で完了まで走るが，結果は捨てられる．
+                そのため，副作用のある呼び出し（メモリーの更新など）には使わず，副作用の無い計算のみを渡して，結果の反映は呼び出し側で行うこと．）
+            max_retries: リトライの最大回数．
+            backoff_base_sec: リトライ前に待つ秒数の基準値．試行ごとに倍になり，ジッターが加わる．
+            backoff_max_sec: リトライ前に待つ秒数の上限．
+            hedge_after_sec: 指定した場合，この秒数を過ぎても応答がなければ同じリクエストをもう 1 つ送り，先に返ってきた方を採用する．
+                副作用のない呼び出し（メモリーを更新しないもの）にのみ使用すること．
+            breaker: サーキットブレーカー．ブレーカーが開いている間は，呼び出しを行わずにフォールバックする．
+        """
+        self.timeout_sec = timeout_sec
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.hedge_after_sec = hedge_after_sec
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+
+    def call(
+        self,
+        fn: Callable[..., T],
+        *args,
+        fn_fallback: Optional[Callable[[], T]] = None,
+        hedge: bool = True,
+        **kwargs
+    ) -> T:
+        """
+        fn(*args, **kwargs) を呼び出す．リトライの待ち時間も含めて呼び出し元のスレッドを止めるため，イベントループからは call_async を使うこと．
+        リトライしても失敗した場合や，ブレーカーが開いている場合は，fn_fallback の結果を返す（無ければ例外を送出する）．
+        OpenAI の利用枠が残っていない場合も，同様にフォールバックする（速度の制限に達している場合は，フォールバックせずに待つ）．
+        """
+        if not self.breaker.allow_request():
+            if fn_fallback is not None:
+                return fn_fallback()
+            raise CircuitOpenError("LLM circuit breaker is open.")
+        if not quota_governor.has_budget("openai", max_level=QuotaLevelEnum.CRITICAL):
+            if fn_fallback is not None:
+                return fn_fallback()
+            raise QuotaExceededError("OpenAI quota is exceeded.")
+        for i_trial in range(self.max_retries + 1):
+            try:
+                result = self._call_once(fn, args, kwargs, hedge=hedge)
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                print(get_error_message(), file=sys.stderr)
+                self.breaker.record_failure()
+                if not is_retryable_error(e) or i_trial == self.max_retries or not self.breaker.allow_request():
+                    if fn_fallback is not None:
+                        return fn_fallback()
+                    raise
+                # 指数バックオフ（フルジッター）
+                time.sleep(random.uniform(0, min(self.backoff_max_sec, self.backoff_base_sec * 2 ** i_trial)))
+        raise AssertionError("unreachable")
+
+    async def call_async(
+        self,
+        fn: Callable[..., T],
+        *args,
+        fn_fallback: Optional[Callable[[], T]] = None,
+        hedge: bool = True,
+        **kwargs
+    ) -> T:
+        """
+        call をイベントループを止めずに実行する．
+        """
+        def _call() -> T:
+            return self.call(fn, *args, fn_fallback=fn_fallback, hedge=hedge, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(None, _call)
+
+    def _call_once(self, fn: Callable[..., T], args, kwargs, hedge: bool) -> T:
+        """
+        制限時間付きで 1 回試行する．必要に応じてヘッジのリクエストを追加で送る．
+        """
+        # 速度の制限に達している場合は，トークンが貯まるまで待つ（制限時間には含めない）
+        quota_governor.wait_for_rate("openai")
+        t0 = time.time()
+        futures: Set[Future] = {self.executor.submit(fn, *args, **kwargs)}
+        quota_governor.record("openai")
+        if hedge and self.hedge_after_sec is not None and self.hedge_after_sec < self.timeout_sec:
+            done, _ = wait(futures, timeout=self.hedge_after_sec)
+            # ヘッジは遅延を縮めるためのものなので，速度の制限に達している場合は送らない
+            if len(done) == 0 and quota_governor.allows("openai", max_level=QuotaLevelEnum.CRITICAL):
+                print(f"LLM call is slow, hedging. {self.hedge_after_sec=}")
+                futures.add(self.executor.submit(fn, *args, **kwargs))
+                quota_governor.record("openai")
+        error: Optional[BaseException] = None
+        while len(futures) > 0:
+            remaining_sec = self.timeout_sec - (time.time() - t0)
+            if remaining_sec <= 0:
+                break
+            done, futures = wait(futures, timeout=remaining_sec, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        if error is not None and len(futures) == 0:
+            raise error
+        raise TimeoutError(f"LLM call timed out. {self.timeout_sec=}")
+
+
+# 共有のクライアント（全ての LLM 呼び出しで，ブレーカーの状態を共有する）
+llm_client = ResilientLLMClient()
@@ -0,0 +1,129 @@
+"""
+長期記憶
+過去のやりとり（チャットと返答の組）を全て手元の索引（BM25）に溜めておき，直近の出来事に関連するものだけをプロンプトに挿入します．
+外部サービスは使用しません．
+"""
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import DefaultDict, Dict, List, Optional, Union
+
+from pydantic import BaseModel, Field
+
+from lib.utils import remove_emojis
+
+
+class Turn(BaseModel):
+    """
+    過去のやりとりを表すクラス
+    """
+    chat: str = Field(..., description="直近の出来事を表すレポート")
+    reply: str = Field(..., description="配信者の返答")
+    time: float = Field(..., description="時刻（UNIX 時間）")
+
+
+# レポートの定型部分など，検索に使わない単語
+STOP_WORDS = ["audience", "streamer"]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    文字 uni-gram と bi-gram に分割する（形態素解析をせずに日本語も扱うため）．英数字は単語単位とする．
+    uni-gram は 1 文字の語（例: 猫）で検索するため，bi-gram は語順を考慮するために使う．
+    """
+    text = remove_emojis(text, " ").lower()
+    tokens = [w for w in re.findall(r"[a-z0-9]+", text) if w not in STOP_WORDS]
+    for chunk in re.findall(r"[^\sa-z0-9!-/:-@\[-`{-~、。！？「」（）『』【】・…〜]+", text):
+        tokens += list(chunk)
+        tokens += [chunk[i:i + 2] for i in range(len(chunk) - 1)]
+    return tokens
+
+
+class LongTermMemory:
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        k1: float = 1.5,
+        b: float = 0.75
+    ):
+        """
+        過去のやりとりを BM25 で検索するためのクラス
+        ----
+        Args:
+            path: 指定した場合，やりとりを jsonl 形式で追記保存し，起動時に読み込む．
+            k1, b: BM25 のパラメータ．
+        """
+        self.path = Path(path) if path is not None else None
+        self.k1 = k1
+        self.b = b
+        self.turns: List[Turn] = []
+        self.doc_lens: List[int] = []
+        self.postings: DefaultDict[str, Dict[int, int]] = defaultdict(dict)  # token -> {turn のインデックス: 出現回数}
+        self.total_len = 0
+        self.lock = threading.Lock()  # 返答の生成（別スレッド）から追加と検索が同時に行われるため
+        if self.path is not None and self.path.is_file():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip() != "":
+                        self._index(Turn(**json.loads(line)))
+
+    def add(self, chat: str, reply: str):
+        """
+        やりとりを記憶する．別スレッドから呼んでもよい．
+        """
+        turn = Turn(chat=chat.strip(), reply=reply.strip(), time=time.time())
+        with self.lock:
+            self._index(turn)
+            if self.path is not None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(turn.json(ensure_ascii=False) + "\n")
+
+    def _index(self, turn: Turn):
+        i = len(self.turns)
+        tokens = tokenize(turn.chat + " " + turn.reply)
+        self.turns.append(turn)
+        self.doc_lens.append(len(tokens))
+        self.total_len += len(tokens)
+        for token, count in Counter(tokens).items():
+            self.postings[token][i] = count
+
+    def search(self, query: str, k: int = 3, skip_recent: int = 5) -> List[Turn]:
+        """
+        query に関連するやりとりを，関連度の高い順に最大 k 件返す．
+        直近 skip_recent 件は会話の要約に含まれているはずなので，対象外とする．別スレッドから呼んでもよい．
+        """
+        query_tokens = set(tokenize(query))
+        with self.lock:
+            num_turns = len(self.turns) - skip_recent
+            if num_turns <= 0:
+                return []
+            avg_len = self.total_len / len(self.turns)
+            scores: DefaultDict[int, float] = defaultdict(float)
+            for token in query_tokens:
+                posting = self.postings.get(token)
+                if not posting:
+                    continue
+                idf = math.log(1 + (len(self.turns) - len(posting) + 0.5) / (len(posting) + 0.5))
+                for i, tf in posting.items():
+                    if i >= num_turns:
+                        continue
+                    scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self.doc_lens[i] / avg_len))
+            best = sorted(scores.items(), key=lambda x: -x[1])[:k]
+            return [self.turns[i] for i, _ in best]
+
+    def build_context(self, query: str, k: int = 3, max_chars: int = 400) -> str:
+        """
+        query に関連する過去のやりとりを，プロンプトに挿入する形式の文字列にする．長さは max_chars 文字以内に収める．
+        """
+        context = ""
+        for turn in self.search(query, k=k):
+            row = f"{turn.chat.strip()}\nStreamer: {turn.reply}\n"
+            if len(context) + len(row) > max_chars:
+                break
+            context += row
+        return context
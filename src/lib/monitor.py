@@ -0,0 +1,119 @@
+"""
+イベントループの監視
+イベントループが止まっている（同期処理がループを占有している）時間を計測し，閾値を超えた場合はその時点のスタックを出力します．
+また，サンプリング方式のプロファイラを提供します．
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+from typing import Optional, Union
+
+
+class LoopWatchdog:
+    def __init__(self, threshold_sec: float = 0.5, interval_sec: float = 0.1):
+        """
+        イベントループの遅延（ラグ）を監視するクラス
+        ----
+        Args:
+            threshold_sec: ラグがこの秒数を超えた場合に，イベントループを占有している処理のスタックを出力する．
+            interval_sec: ハートビートの間隔．
+        """
+        self.threshold_sec = threshold_sec
+        self.interval_sec = interval_sec
+        self.last_heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.max_lag_sec = 0.0
+        self.num_stalls = 0
+
+    async def run(self):
+        """
+        ハートビートを打ち続けるループ．監視用のスレッドもここで起動する．
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.last_heartbeat = time.monotonic()
+        threading.Thread(target=self._watch, daemon=True).start()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval_sec)
+            lag_sec = time.monotonic() - t0 - self.interval_sec
+            self.max_lag_sec = max(self.max_lag_sec, lag_sec)
+            if lag_sec > self.threshold_sec:
+                print(f"Event loop lag: {lag_sec:.3f} sec", file=sys.stderr)
+            self.last_heartbeat = time.monotonic()
+
+    def _watch(self):
+        """
+        別スレッドでハートビートを監視し，途絶えている間にイベントループのスレッドのスタックを出力する（1 回の停止につき 1 回）．
+        """
+        reported_heartbeat: Optional[float] = None
+        while True:
+            time.sleep(self.interval_sec)
+            heartbeat = self.last_heartbeat
+            if time.monotonic() - heartbeat <= self.threshold_sec + self.interval_sec or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.num_stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id) if self.loop_thread_id is not None else None
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                print(f"Event loop is blocked for more than {self.threshold_sec} sec:\n{stack}", file=sys.stderr)
+
+
+class SamplingProfiler:
+    def __init__(self, interval_sec: float = 0.005, thread_id: Optional[int] = None):
+        """
+        一定間隔でスタックを採取するプロファイラ．結果は flamegraph.pl 等で読める folded 形式で書き出す．
+        ----
+        Args:
+            interval_sec: サンプリング間隔．
+            thread_id: 対象のスレッド．None の場合は全スレッドを対象とする．
+        """
+        self.interval_sec = interval_sec
+        self.thread_id = thread_id
+        self.samples: Counter = Counter()
+        self.is_running = False
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+
+    def _sample(self):
+        own_thread_id = threading.get_ident()
+        while self.is_running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+                stack = ";".join(
+                    f"{f.name} ({Path(f.filename).name}:{f.lineno})" for f in traceback.extract_stack(frame)
+                )
+                self.samples[stack] += 1
+            time.sleep(self.interval_sec)
+
+    def dump(self, path: Union[str, Path]):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+async def profile_for(sec: float, path: Union[str, Path], interval_sec: float = 0.005):
+    """
+    sec 秒間プロファイルを採取し，path に書き出す．
+    """
+    profiler = SamplingProfiler(interval_sec=interval_sec)
+    print(f"Profiling started. {sec=} {path=}")
+    profiler.start()
+    try:
+        await asyncio.sleep(sec)
+    finally:
+        profiler.stop()
+        profiler.dump(path)
+    print(f"Profiling finished. {path=}")
@@ -0,0 +1,311 @@
+"""
+外部 API の利用枠の管理
+OpenAI・Google Text-to-Speech・YouTube Data API・SerpAPI の使用量を数えてファイルに保存し，残りの枠に応じて段階的に使用を控えさせます．
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from enum import Enum, IntEnum
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+from zoneinfo import ZoneInfo
+
+from pydantic import BaseModel, Field
+
+from lib.utils import get_error_message
+
+
+class QuotaLevelEnum(IntEnum):
+    """
+    残りの枠に応じた節約の段階（大きいほど節約する）
+    """
+    NORMAL = 0  # 通常通り
+    SAVING = 1  # 節約する（YouTube の取得間隔を延ばす，TV の放送内容を LLM で生成しない）
+    CRITICAL = 2  # 最低限にする（Neural TTS を使わない，Google Home はキャッシュからのみ答える）
+    EXHAUSTED = 3  # 使わない
+
+
+class QuotaPeriodEnum(str, Enum):
+    """
+    使用量をリセットする周期
+    """
+    DAY = "day"
+    MONTH = "month"
+
+
+class QuotaSpec(BaseModel):
+    """
+    1 つの API の利用枠
+    """
+    unit: str = Field(..., description="使用量の単位")
+    limit: Optional[float] = Field(None, description="1 周期あたりの上限．None の場合は無制限（使用量を数えるのみ）")
+    period: QuotaPeriodEnum = Field(QuotaPeriodEnum.MONTH, description="使用量をリセットする周期")
+    timezone: Optional[str] = Field(None, description="周期の区切りのタイムゾーン．None の場合はローカル時刻")
+    rate_per_min: Optional[float] = Field(None, description="トークンバケットの補充速度（1 分あたり）．None の場合は速度を制限しない")
+    burst: float = Field(1.0, description="トークンバケットの容量（一度に使える量）")
+
+
+# README に記載の無料枠（2022 年 12 月現在）に基づく既定値
+DEFAULT_QUOTAS: Dict[str, QuotaSpec] = {
+    # クレジット制で上限は無いため，速度のみ制限する
+    "openai": QuotaSpec(unit="requests", rate_per_min=30, burst=10),
+    # Neural2 などの音声は 1 ヶ月あたり 100 万文字まで無料
+    "google_tts": QuotaSpec(unit="characters", limit=1_000_000, rate_per_min=3_000, burst=1_000),
+    # Standard の音声は 1 ヶ月あたり 400 万文字まで無料
+    "google_tts_standard": QuotaSpec(unit="characters", limit=4_000_000, rate_per_min=3_000, burst=1_000),
+    # 1 日あたり 10,000 units（太平洋時間の 0 時にリセット）．チャットの取得は 1 回 5 units
+    "youtube": QuotaSpec(unit="units", limit=10_000, period=QuotaPeriodEnum.DAY, timezone="America/Los_Angeles", rate_per_min=60, burst=10),
+    # Free Plan は 1 ヶ月あたり 100 回の検索まで
+    "serpapi": QuotaSpec(unit="searches", limit=100, rate_per_min=1, burst=3),
+}
+
+
+class QuotaUsage(BaseModel):
+    """
+    1 つの API の使用量（ファイルに保存する）
+    """
+    period_key: str = Field(..., description="周期を表す文字列（例: 2022-12, 2022-12-31）")
+    used: float = Field(0.0, description="この周期の使用量")
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: float, fn_time: Callable[[], float] = time.monotonic):
+        """
+        トークンバケット．消費はトークンが足りなくても行い（借りを作り），補充されるまで allows が False を返す．
+        ----
+        Args:
+            rate_per_sec: 1 秒あたりに補充するトークン数．
+            capacity: 貯められるトークン数の上限．
+        """
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity
+        self.fn_time = fn_time
+        self.tokens = capacity
+        self.updated_at = fn_time()
+
+    def _refill(self):
+        now = self.fn_time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_sec)
+        self.updated_at = now
+
+    def allows(self, amount: float = 1.0) -> bool:
+        """
+        amount だけ消費してよいかを返す（容量より大きい場合は，満杯であれば許可する）．
+        """
+        self._refill()
+        return self.tokens >= min(amount, self.capacity)
+
+    def consume(self, amount: float = 1.0):
+        self._refill()
+        self.tokens -= amount
+
+    def wait_sec(self, amount: float = 1.0) -> float:
+        """
+        amount だけ消費してよくなるまでの秒数（既によい場合は 0）．
+        """
+        self._refill()
+        return max(0.0, min(amount, self.capacity) - self.tokens) / self.rate_per_sec
+
+
+class QuotaGovernor:
+    def __init__(
+        self,
+        quotas: Dict[str, QuotaSpec] = DEFAULT_QUOTAS,
+        path: Optional[Union[str, Path]] = None,
+        saving_ratio: float = 0.3,
+        critical_ratio: float = 0.1
+    ):
+        """
+        外部 API の利用枠を管理するクラス
+        ----
+        Args:
+            quotas: API 名から利用枠への辞書．
+            path: 使用量を保存するファイル．None の場合は保存しない．
+            saving_ratio: 残りの枠の割合がこれ以下になると，節約する（SAVING）．
+            critical_ratio: 残りの枠の割合がこれ以下になると，最低限にする（CRITICAL）．
+        """
+        self.quotas = {name: spec.copy() for name, spec in quotas.items()}
+        self.path = Path(path) if path is not None else None
+        self.saving_ratio = saving_ratio
+        self.critical_ratio = critical_ratio
+        self.usages: Dict[str, QuotaUsage] = {}
+        self.buckets = {
+            name: TokenBucket(spec.rate_per_min / 60, spec.burst)
+            for name, spec in self.quotas.items() if spec.rate_per_min is not None
+        }
+        self.is_dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, path: Union[str, Path]):
+        """
+        保存された使用量を読み込み，以降はこのファイルに保存する．周期が変わっていた場合は 0 から数え直す．
+        """
+        self.path = Path(path)
+        if not self.path.is_file():
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                usages = json.load(f).get("usages", {})
+            with self.lock:
+                self.usages = {name: QuotaUsage(**usage) for name, usage in usages.items()}
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+
+    def save(self):
+        """
+        使用量と残りの枠をファイルに保存する．一時ファイルに書いてから置き換える．
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            content = json.dumps({
+                "usages": {name: usage.dict() for name, usage in self.usages.items()},
+                "metrics": self._metrics()
+            }, ensure_ascii=False, indent=2)
+            self.is_dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, path_tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path_tmp, self.path)
+        except Exception:
+            if os.path.exists(path_tmp):
+                os.remove(path_tmp)
+            raise
+
+    def _usage(self, name: str) -> QuotaUsage:
+        spec = self.quotas[name]
+        now = datetime.now(ZoneInfo(spec.timezone)) if spec.timezone is not None else datetime.now()
+        period_key = now.strftime("%Y-%m-%d" if spec.period is QuotaPeriodEnum.DAY else "%Y-%m")
+        usage = self.usages.get(name)
+        if usage is None or usage.period_key != period_key:
+            usage = self.usages[name] = QuotaUsage(period_key=period_key)
+        return usage
+
+    def record(self, name: str, amount: float = 1.0):
+        """
+        API を amount だけ使用したことを記録する（API を呼び出す箇所で使う）．
+        """
+        if name not in self.quotas:
+            return
+        with self.lock:
+            self._usage(name).used += amount
+            if name in self.buckets:
+                self.buckets[name].consume(amount)
+            self.is_dirty = True
+
+    def remaining(self, name: str) -> Optional[float]:
+        """
+        この周期の残りの枠．上限が無い場合は None．
+        """
+        spec = self.quotas.get(name)
+        if spec is None or spec.limit is None:
+            return None
+        with self.lock:
+            return max(0.0, spec.limit - self._usage(name).used)
+
+    def level(self, name: str) -> QuotaLevelEnum:
+        """
+        残りの枠の割合から，節約の段階を決める．
+        """
+        spec = self.quotas.get(name)
+        remaining = self.remaining(name)
+        if spec is None or spec.limit is None or remaining is None:
+            return QuotaLevelEnum.NORMAL
+        ratio = remaining / spec.limit if spec.limit > 0 else 0.0
+        if ratio <= 0:
+            return QuotaLevelEnum.EXHAUSTED
+        if ratio <= self.critical_ratio:
+            return QuotaLevelEnum.CRITICAL
+        if ratio <= self.saving_ratio:
+            return QuotaLevelEnum.SAVING
+        return QuotaLevelEnum.NORMAL
+
+    def allows(self, name: str, amount: float = 1.0, max_level: QuotaLevelEnum = QuotaLevelEnum.SAVING) -> bool:
+        """
+        API を amount だけ使ってよいかを返す（使用するかを決める箇所で使う）．
+        節約の段階が max_level を超えている場合や，残りの枠が足りない場合，トークンバケットが空の場合は False．
+        """
+        if not self.has_budget(name, amount, max_level=max_level):
+            return False
+        with self.lock:
+            return name not in self.buckets or self.buckets[name].allows(amount)
+
+    def has_budget(self, name: str, amount: float = 1.0, max_level: QuotaLevelEnum = QuotaLevelEnum.SAVING) -> bool:
+        """
+        allows と同じだが，トークンバケット（速度の制限）は考慮しない．
+        """
+        if name not in self.quotas:
+            return True
+        if self.level(name) > max_level:
+            return False
+        remaining = self.remaining(name)
+        return remaining is None or remaining >= amount
+
+    def wait_for_rate(self, name: str, amount: float = 1.0):
+        """
+        トークンバケットに amount だけ貯まるまで，呼び出し元のスレッドを止めて待つ（イベントループからは呼ばないこと）．
+        """
+        while name in self.buckets:
+            with self.lock:
+                wait_sec = self.buckets[name].wait_sec(amount)
+            if wait_sec <= 0:
+                return
+            time.sleep(wait_sec)
+
+    def _metrics(self) -> Dict[str, Dict]:
+        metrics: Dict[str, Dict] = {}
+        for name, spec in self.quotas.items():
+            usage = self._usage(name)
+            bucket = self.buckets.get(name)
+            metrics[name] = {
+                "unit": spec.unit,
+                "period": usage.period_key,
+                "used": usage.used,
+                "limit": spec.limit,
+                "remaining": None if spec.limit is None else max(0.0, spec.limit - usage.used),
+                "tokens": None if bucket is None else bucket.tokens,
+            }
+        return metrics
+
+    @property
+    def metrics(self) -> Dict[str, Dict]:
+        """
+        API ごとの使用量・残りの枠・節約の段階
+        """
+        with self.lock:
+            metrics = self._metrics()
+        for name in metrics:
+            metrics[name]["level"] = self.level(name).name
+        return metrics
+
+
+async def quota_loop(governor: QuotaGovernor, interval_sec: float = 10.0):
+    """
+    定期的に使用量を保存し，節約の段階が変わったら表示するループ
+    """
+    levels = {name: governor.level(name) for name in governor.quotas}
+    while True:
+        await asyncio.sleep(interval_sec)
+        for name in governor.quotas:
+            level = governor.level(name)
+            if level != levels[name]:
+                print(f"Quota level of {name} is changed: {levels[name].name} -> {level.name}. remaining={governor.remaining(name)}")
+                levels[name] = level
+        if governor.is_dirty:
+            try:
+                governor.save()
+            except Exception:
+                print(get_error_message(), file=sys.stderr)
+
+
+# 共有の利用枠（API を呼び出す全ての箇所で，使用量を共有する）
+quota_governor = QuotaGovernor()
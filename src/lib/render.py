@@ -0,0 +1,131 @@
+"""
+オフラインレンダリング
+チャットの台本を GPTuber に流して，音声ファイル（発話ごと・全体）と字幕ファイル（WebVTT / SRT）・エモートの指示を書き出します．
+実時間では待たずに（仮想時刻で）台詞を決めた後，各発話の音声合成を並列に行います．
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
+
+from pydantic import BaseModel, Field
+
+from lib.gptuber import generate_subtitle_timeline
+from lib.simulation import SimulatedSpeaker
+from lib.tts.tts import GOOGLE_TTS_VOICES, AudioInfo, SpeechModeEnum, synthesize_to_file
+
+
+class Segment(BaseModel):
+    """
+    1 回の発話を表すクラス
+    """
+    text: str = Field(..., description="発話内容テキスト")
+    mode: SpeechModeEnum = Field(..., description="TTS のモード")
+    start_sec: float = Field(0.0, description="全体の音声における開始時刻")
+    duration_sec: float = Field(0.0, description="再生時間")
+    path: Optional[str] = Field(None, description="音声ファイルへのパス")
+
+
+class ScriptRecorder(SimulatedSpeaker):
+    """
+    GPTuber の fn_synthesize, fn_play として使用し，実際には合成・再生せずに発話内容を記録する．
+    """
+    def __init__(self):
+        super().__init__()
+        self.segments: List[Segment] = []
+
+    def play(self, audio: AudioInfo, callback: Optional[Callable] = None) -> None:
+        assert audio.duration_sec is not None
+        self.segments.append(Segment(text=audio.text, mode=audio.mode, duration_sec=audio.duration_sec))
+        super().play(audio, callback=callback)
+
+
+def synthesize_segments(
+    segments: List[Segment],
+    out_dir: Union[str, Path],
+    max_workers: int = 4,
+    no_tts: bool = False
+) -> List[Segment]:
+    """
+    各発話の音声を並列に合成し，実際の再生時間に基づいて，隙間なく並べた時の開始時刻を決める．
+    no_tts が True の場合は合成せず，見積もった再生時間を使う．
+    """
+    out_path = Path(out_dir)
+    (out_path / "segments").mkdir(parents=True, exist_ok=True)
+
+    def _synthesize(i_segment: Tuple[int, Segment]) -> Tuple[Optional[str], float]:
+        i, segment = i_segment
+        if no_tts:
+            return None, segment.duration_sec
+        audio = synthesize_to_file(segment.text, str(out_path / "segments" / f"{i:04d}.mp3"), voice=GOOGLE_TTS_VOICES[segment.mode])
+        return audio.path, audio.duration_sec if audio.duration_sec is not None else segment.duration_sec
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_synthesize, enumerate(segments)))
+
+    rendered: List[Segment] = []
+    t = 0.0
+    for segment, (path, duration_sec) in zip(segments, results):
+        rendered.append(Segment(text=segment.text, mode=segment.mode, start_sec=t, duration_sec=duration_sec, path=path))
+        t += duration_sec
+    return rendered
+
+
+def concat_mp3(paths: List[str], out_path: Union[str, Path]):
+    """
+    MP3 ファイルを連結する（MP3 はフレームの並びなので，バイト列をそのままつなげれば再生できる）．
+    """
+    with open(out_path, "wb") as f_out:
+        for path in paths:
+            with open(path, "rb") as f_in:
+                f_out.write(f_in.read())
+
+
+def format_timestamp(sec: float, sep: str = ".") -> str:
+    ms = int(round(sec * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}{sep}{ms % 1000:03d}"
+
+
+def build_cues(segments: List[Segment]) -> Tuple[List[Tuple[float, float, str]], List[Tuple[float, str]]]:
+    """
+    字幕のキュー (開始時刻, 終了時刻, 字幕) のリストと，エモートのキュー (時刻, エモート) のリストを作る．
+    """
+    subtitle_cues: List[Tuple[float, float, str]] = []
+    emote_cues: List[Tuple[float, str]] = []
+    for segment in segments:
+        is_streamer = segment.mode is not SpeechModeEnum.CLASSIC_EN
+        timeline = generate_subtitle_timeline(
+            segment.text,
+            flg_split=is_streamer,
+            prefix="" if is_streamer else "(Google Home) ",
+            duration_sec=segment.duration_sec
+        )
+        for (t0, text, emote), (t1, _, _) in zip(timeline[:-1], timeline[1:]):
+            if text.strip() != "":
+                subtitle_cues.append((segment.start_sec + float(t0), segment.start_sec + float(t1), text.strip()))
+            if emote is not None:
+                emote_cues.append((segment.start_sec + float(t0), emote))
+    return subtitle_cues, emote_cues
+
+
+def write_outputs(segments: List[Segment], out_dir: Union[str, Path]):
+    """
+    全体の音声・字幕（WebVTT, SRT）・エモートの指示・発話一覧を書き出す．
+    """
+    out_dir = Path(out_dir)
+    paths = [s.path for s in segments if s.path is not None and os.path.exists(s.path)]
+    if len(paths) > 0:
+        concat_mp3(paths, out_dir / "track.mp3")
+    subtitle_cues, emote_cues = build_cues(segments)
+    with open(out_dir / "subtitles.vtt", "w", encoding="utf-8") as f:
+        f.write("WEBVTT\n\n")
+        for t0, t1, text in subtitle_cues:
+            f.write(f"{format_timestamp(t0)} --> {format_timestamp(t1)}\n{text}\n\n")
+    with open(out_dir / "subtitles.srt", "w", encoding="utf-8") as f:
+        for i, (t0, t1, text) in enumerate(subtitle_cues):
+            f.write(f"{i + 1}\n{format_timestamp(t0, ',')} --> {format_timestamp(t1, ',')}\n{text}\n\n")
+    with open(out_dir / "emotes.json", "w", encoding="utf-8") as f:
+        json.dump([{"sec": t, "emote": emote} for t, emote in emote_cues], f, ensure_ascii=False, indent=2)
+    with open(out_dir / "segments.json", "w", encoding="utf-8") as f:
+        json.dump([s.dict() for s in segments], f, ensure_ascii=False, indent=2)
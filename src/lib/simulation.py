@@ -0,0 +1,102 @@
+"""
+仮想時刻によるシミュレーション
+asyncio.sleep などの待ち時間を実際には待たずに仮想時刻を進めることで，数時間分の配信を数秒で再現します．
+"""
+import asyncio
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from lib.gptuber import generate_subtitle_timeline
+from lib.tts.tts import AudioInfo, SpeechModeEnum
+from lib.youtube import ChatLog
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """
+    仮想時刻で動くイベントループ．実行可能なタスクが無くなった時点で，次のタイマーの時刻まで仮想時刻を進める．
+    別スレッドで実行中の処理（run_in_executor）がある間は仮想時刻を止め，その完了を実時間で待つ．
+    そのため，LLM 等の処理時間は仮想時刻に含まれず，結果はスレッドのタイミングに依らない．
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.virtual_time = 0.0
+        self.epoch_offset = time.time()  # 仮想時刻 0 に対応する UNIX 時間
+        self.num_executor_jobs = 0  # 別スレッドで実行中の処理の数
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.num_executor_jobs += 1
+        future.add_done_callback(self._on_executor_job_done)
+        return future
+
+    def _on_executor_job_done(self, future: asyncio.Future):
+        self.num_executor_jobs -= 1
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def unix_time(self) -> float:
+        """
+        仮想時刻を UNIX 時間に換算して返す（GPTuber の fn_time に渡す用）．
+        """
+        return self.epoch_offset + self.virtual_time
+
+    def _run_once(self):
+        # NOTE: asyncio.BaseEventLoop の内部実装（_ready, _scheduled）に依存している
+        # 別スレッドの処理が終わるまでは時刻を進めない（完了時にセレクタが起こされる）
+        if not self._ready and self._scheduled and self.num_executor_jobs == 0:  # type: ignore
+            when = self._scheduled[0]._when  # type: ignore
+            if when > self.virtual_time:
+                self.virtual_time = when
+        super()._run_once()  # type: ignore
+
+
+class SimulatedSpeaker:
+    """
+    実際には合成・再生せず，字幕のタイムラインから見積もった再生時間だけ（仮想時刻で）待ってから callback を呼び出す．
+    """
+    def __init__(self):
+        self.num_utterances = 0
+        self.total_speech_sec = 0.0
+
+    async def synthesize(self, text: str, mode: SpeechModeEnum) -> AudioInfo:
+        duration_sec = float(generate_subtitle_timeline(text, flg_split=False)[-1][0])
+        return AudioInfo(text=text, mode=mode, duration_sec=duration_sec)
+
+    def play(self, audio: AudioInfo, callback: Optional[Callable] = None) -> None:
+        assert audio.duration_sec is not None
+        self.num_utterances += 1
+        self.total_speech_sec += audio.duration_sec
+        if callback is not None:
+            asyncio.get_running_loop().call_later(audio.duration_sec, callback)
+
+
+class SimulatedChatSource:
+    """
+    視聴者のチャットを，ポアソン過程で擬似的に生成する．
+    """
+    def __init__(
+        self,
+        fn_time: Callable[[], float],
+        chats_per_min: float = 1.0,
+        messages: List[str] = ["こんにちは", "かわいい", "今日は何してたの？", "OK Google って何？", "おやすみ"],
+        seed: Optional[int] = None
+    ):
+        self.fn_time = fn_time
+        self.chats_per_min = chats_per_min
+        self.messages = messages
+        self.rng = np.random.default_rng(seed)
+        self.last_time = fn_time()
+        self.num_chats = 0
+
+    def get_recent_chats(self) -> List[ChatLog]:
+        current_time = self.fn_time()
+        num_chats = int(self.rng.poisson(self.chats_per_min * (current_time - self.last_time) / 60))
+        self.last_time = current_time
+        self.num_chats += num_chats
+        return [
+            ChatLog(name=f"viewer{self.rng.integers(100)}", message=self.messages[self.rng.integers(len(self.messages))])
+            for _ in range(num_chats)
+        ]
@@ -0,0 +1,148 @@
+"""
+配信者の状態のスナップショット
+バックエンドを再起動しても，会話の要約や未消化の行動，チャットの取得位置を引き継げるようにします．
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from langchain.chains.conversation.memory import ConversationSummaryMemory
+from pydantic import BaseModel, Field
+
+from lib.chat_bus import ChatBus, ChatCursor
+from lib.gptuber import Action, GPTuber
+from lib.utils import get_error_message
+from lib.youtube import ChatLog, ChatMonitor
+
+
+class StreamerSnapshot(BaseModel):
+    """
+    配信者の状態を表すクラス
+    """
+    saved_at: float = Field(..., description="保存時刻（UNIX 時間）")
+    summary: str = Field("", description="ここまでの会話の要約")
+    last_chat_time: float = Field(..., description="最後に視聴者のチャットがあった時刻")
+    last_non_boring_time: float = Field(..., description="最後に暇でなくなった時刻")
+    final_answer_from_google_home: Optional[str] = Field(None, description="未報告の Google Home からの答え")
+    actions_reserved: List[Action] = Field(default_factory=list, description="未消化の行動")
+    next_page_token: Optional[str] = Field(None, description="YouTube のチャット取得位置")
+    chat_logs_unread: List[ChatLog] = Field(default_factory=list, description="取得済みだが，まだ返答していないチャット")
+    google_home_cache: Dict[str, str] = Field(default_factory=dict, description="Google Home の答えのキャッシュ（古い順）")
+
+
+def take_snapshot(
+    gptuber: GPTuber,
+    memory: Optional[ConversationSummaryMemory] = None,
+    chat_monitor: Optional[ChatMonitor] = None,
+    chat_bus: Optional[ChatBus] = None,
+    chat_cursor: Optional[ChatCursor] = None,
+    max_chats_unread: int = 20
+) -> StreamerSnapshot:
+    """
+    現在の状態からスナップショットを作成する．
+    チャットの取得位置は先に進んでいるため，チャットバスに残っている未読のチャットと未消化のチャットも（新しいものから max_chats_unread 件まで）保存する．
+    """
+    chat_logs_unread = list(gptuber.chat_logs_pending)
+    if chat_bus is not None and chat_cursor is not None:
+        chat_logs_unread += chat_bus.peek(chat_cursor)
+    return StreamerSnapshot(
+        saved_at=time.time(),
+        summary=memory.buffer if memory is not None else "",
+        last_chat_time=gptuber.last_chat_time,
+        last_non_boring_time=gptuber.last_non_boring_time,
+        final_answer_from_google_home=gptuber.final_answer_from_google_home,
+        actions_reserved=[a.copy() for a in gptuber.actions_reserved],
+        # MockChatMonitor は next_page_token を持たない
+        next_page_token=getattr(chat_monitor, "next_page_token", None),
+        chat_logs_unread=[c.copy() for c in chat_logs_unread[-max_chats_unread:]] if max_chats_unread > 0 else [],
+        google_home_cache=dict(gptuber.google_home_cache)
+    )
+
+
+def restore_snapshot(
+    snapshot: StreamerSnapshot,
+    gptuber: GPTuber,
+    memory: Optional[ConversationSummaryMemory] = None,
+    chat_monitor: Optional[ChatMonitor] = None
+) -> None:
+    """
+    スナップショットの内容を現在の状態に書き戻す．
+    """
+    if memory is not None:
+        memory.buffer = snapshot.summary
+    gptuber.last_chat_time = snapshot.last_chat_time
+    gptuber.last_non_boring_time = snapshot.last_non_boring_time
+    gptuber.final_answer_from_google_home = snapshot.final_answer_from_google_home
+    gptuber.actions_reserved = list(snapshot.actions_reserved) + gptuber.actions_reserved
+    gptuber.chat_logs_pending = list(snapshot.chat_logs_unread) + gptuber.chat_logs_pending
+    for cache_key, answer in snapshot.google_home_cache.items():
+        gptuber.cache_google_home_answer(cache_key, answer)
+    if chat_monitor is not None and hasattr(chat_monitor, "next_page_token"):
+        chat_monitor.next_page_token = snapshot.next_page_token
+
+
+def save_snapshot(path: Union[str, Path], snapshot: StreamerSnapshot) -> None:
+    """
+    スナップショットをファイルに保存する．書き込み途中で落ちても壊れたファイルが残らないよう，一時ファイルに書いてから置き換える．
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, path_tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(snapshot.json(ensure_ascii=False))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_tmp, path)
+    except Exception:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        raise
+
+
+def load_snapshot(path: Union[str, Path]) -> Optional[StreamerSnapshot]:
+    """
+    ファイルからスナップショットを読み込む．存在しない場合や壊れている場合は None を返す．
+    """
+    path = Path(path)
+    if not path.is_file():
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return StreamerSnapshot(**json.load(f))
+    except Exception:
+        print(get_error_message(), file=sys.stderr)
+        return None
+
+
+async def snapshot_loop(
+    path: Union[str, Path],
+    gptuber: GPTuber,
+    memory: Optional[ConversationSummaryMemory] = None,
+    chat_monitor: Optional[ChatMonitor] = None,
+    chat_bus: Optional[ChatBus] = None,
+    chat_cursor: Optional[ChatCursor] = None,
+    max_chats_unread: int = 20,
+    interval_sec: float = 30.0
+) -> None:
+    """
+    定期的にスナップショットを保存するループ
+    """
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            save_snapshot(path, take_snapshot(
+                gptuber,
+                memory=memory,
+                chat_monitor=chat_monitor,
+                chat_bus=chat_bus,
+                chat_cursor=chat_cursor,
+                max_chats_unread=max_chats_unread
+            ))
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
@@ -0,0 +1,64 @@
+"""
+ブラウザでの音声再生
+バックエンドでは再生せずに，合成した音声を WebSocket のバイナリフレームでフロントエンドに送ります．
+バックエンドに音声デバイスが無くても（Linux サーバー等でも）動かせます．
+"""
+import asyncio
+import json
+import os
+import struct
+from typing import Callable, Optional
+
+from lib.tts.tts import GOOGLE_TTS_VOICES, AudioInfo, SpeechModeEnum, synthesize_to_file
+
+
+def encode_audio_frame(utterance_id: str, seq: int, is_last: bool, chunk: bytes) -> bytes:
+    """
+    音声のバイナリフレームを作る．
+    形式は [ヘッダ長 (uint32, big endian)][ヘッダ (JSON, UTF-8)][音声データ (MP3)]．ヘッダは {"id": 発話の ID, "seq": 連番, "last": 最後か}．
+    """
+    header = json.dumps({"id": utterance_id, "seq": seq, "last": is_last}).encode("utf-8")
+    return struct.pack(">I", len(header)) + header + chunk
+
+
+class BrowserAudioPlayer:
+    def __init__(self, fn_send_message: Callable[[bytes], None], chunk_size: int = 16 * 1024):
+        """
+        GPTuber の fn_synthesize, fn_play として使用し，音声をフロントエンドに送るクラス
+        ----
+        Args:
+            fn_send_message: フロントエンドにバイナリフレームを送る関数．
+            chunk_size: 1 フレームあたりの音声データのバイト数．
+        """
+        self.fn_send_message = fn_send_message
+        self.chunk_size = chunk_size
+
+    async def synthesize(self, text: str, mode: SpeechModeEnum) -> AudioInfo:
+        """
+        全てのモードで，Google の Text-to-Speech API により MP3 に合成する（say コマンドは使わない）．
+        """
+        this_directory = os.path.dirname(__file__)
+        audio = AudioInfo(text=text, mode=mode)
+        path = os.path.join(this_directory, "tmp", f"{audio.id}.mp3")
+        audio_synthesized = await asyncio.get_running_loop().run_in_executor(None, synthesize_to_file, text, path, GOOGLE_TTS_VOICES[mode])
+        return AudioInfo(
+            id=audio.id,
+            text=audio_synthesized.text,
+            mode=mode,
+            path=audio_synthesized.path,
+            duration_sec=audio_synthesized.duration_sec
+        )
+
+    def play(self, audio: AudioInfo, callback: Optional[Callable] = None) -> None:
+        """
+        音声をフロントエンドに送る．再生時間が経過した時点で callback を呼び出す．
+        """
+        assert audio.path is not None
+        with open(audio.path, "rb") as f:
+            data = f.read()
+        os.remove(audio.path)
+        chunks = [data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size)] or [b""]
+        for seq, chunk in enumerate(chunks):
+            self.fn_send_message(encode_audio_frame(audio.id, seq, seq == len(chunks) - 1, chunk))
+        if callback is not None:
+            asyncio.get_running_loop().call_later(audio.duration_sec or 0.0, callback)
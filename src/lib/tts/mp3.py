@@ -0,0 +1,75 @@
+"""
+MP3 ファイルの再生時間の取得
+デコードせずに，フレームヘッダのみを読んで再生時間を計算します．
+REF: http://www.mp3-tech.org/programmer/frame_header.html
+"""
+from pathlib import Path
+from typing import Optional, Union
+
+# ビットレート（kbps）: [MPEG-1 かどうか][レイヤー][インデックス]
+BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+
+# サンプリングレート（Hz）: [バージョンのビット][インデックス]
+SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],  # MPEG-1
+    0b10: [22050, 24000, 16000],  # MPEG-2
+    0b00: [11025, 12000, 8000],  # MPEG-2.5
+}
+
+
+def get_mp3_duration(path: Union[str, Path]) -> Optional[float]:
+    """
+    MP3 ファイルの再生時間（秒）を返す．フレームが 1 つも見つからない場合は None を返す．
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    # ID3v2 タグを読み飛ばす
+    if data[:3] == b"ID3" and len(data) >= 10:
+        offset = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+
+    duration_sec = 0.0
+    num_frames = 0
+    while offset + 4 <= len(data):
+        b1, b2 = data[offset + 1], data[offset + 2]
+        if data[offset] != 0xff or (b1 & 0xe0) != 0xe0:
+            # 同期ワードでなければ 1 バイトずつずらして探す
+            offset += 1
+            continue
+        version_bits = (b1 >> 3) & 0b11
+        layer = 4 - ((b1 >> 1) & 0b11)
+        bitrate_index = b2 >> 4
+        sample_rate_index = (b2 >> 2) & 0b11
+        padding = (b2 >> 1) & 0b1
+        if version_bits == 0b01 or layer == 4 or bitrate_index in [0, 15] or sample_rate_index == 3:
+            offset += 1
+            continue
+        is_mpeg1 = version_bits == 0b11
+        bitrate = BITRATES[is_mpeg1][layer][bitrate_index] * 1000
+        sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+        if layer == 1:
+            samples_per_frame = 384
+            frame_length = (12 * bitrate // sample_rate + padding) * 4
+        else:
+            samples_per_frame = 1152 if layer == 2 or is_mpeg1 else 576
+            frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+        if frame_length <= 0:
+            offset += 1
+            continue
+        duration_sec += samples_per_frame / sample_rate
+        num_frames += 1
+        offset += frame_length
+
+    return duration_sec if num_frames > 0 else None
@@ -1,9 +1,16 @@
+import asyncio
 from enum import Enum
 import os
 import re
 import subprocess
-from typing import Callable, Optional
+import uuid
+from typing import Awaitable, Callable, Optional
+from typing_extensions import Protocol
 
+from pydantic import BaseModel, Field
+
+from lib.quota import quota_governor
+from lib.tts.mp3 import get_mp3_duration
 from lib.utils import popen_with_callback, remove_emojis, remove_successive_spaces, remove_control_characters
 
 
@@ -16,47 +23,126 @@ class SpeechModeEnum(str, Enum):
     CLASSIC_EN = "classic-en"
 
 
-def speak(
-    text: str,
-    mode: SpeechModeEnum,
-    callback: Optional[Callable] = None
-) -> None:
+# 音声ファイルに合成する場合の，モードごとの Google Text-to-Speech の声（CLASSIC は無料枠の大きい Standard の声）
+GOOGLE_TTS_VOICES = {
+    SpeechModeEnum.NEURAL_JP: "ja-JP-Neural2-B",
+    SpeechModeEnum.CLASSIC_JP: "ja-JP-Standard-B",
+    SpeechModeEnum.CLASSIC_EN: "en-US-Standard-F",
+}
+
+
+class AudioInfo(BaseModel):
     """
-    text を喋る．
+    合成した音声の情報
+    """
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex, description="発話の ID（字幕の表示指示と音声の対応付けに使う）")
+    text: str = Field(..., description="TTS に入力したテキスト")
+    mode: SpeechModeEnum = Field(..., description="TTS のモード")
+    path: Optional[str] = Field(None, description="音声ファイルへのパス（再生時に合成するモードの場合は None）")
+    duration_sec: Optional[float] = Field(None, description="再生時間（秒）．不明な場合は None")
+
+
+class FnSynthesize(Protocol):
+    def __call__(self, text: str, mode: SpeechModeEnum) -> Awaitable[AudioInfo]:
+        ...
+
+
+class FnPlay(Protocol):
+    def __call__(self, audio: AudioInfo, callback: Optional[Callable] = None) -> None:
+        ...
+
+
+def synthesize(text: str, mode: SpeechModeEnum) -> AudioInfo:
+    """
+    text の音声を合成する（再生はしない）．
     """
     this_directory = os.path.dirname(__file__)
-    text = convert_text_for_speech(text)
+    text_for_tts = convert_text_for_speech(text)
     if mode is SpeechModeEnum.NEURAL_JP:
-        # 日本語を綺麗に喋る
-        text_for_tts = convert_text_for_speech(text)
-        proc = subprocess.run(
-            ["sh", "./tts.sh", text_for_tts],
-            cwd=this_directory,
-            stdout=subprocess.PIPE
-        )
-        path_to_audio_file = proc.stdout.decode("utf-8").strip()
-        # 音声ファイルの再生開始（再生終了まで待たない．再生終了時に callback 実行）
+        # 日本語を綺麗に喋る．再生中に次の音声を合成しても上書きしないよう，ファイル名は毎回変える．
+        return synthesize_to_file(text, os.path.join(this_directory, "tmp", f"{uuid.uuid4().hex}.mp3"))
+    elif mode in [SpeechModeEnum.CLASSIC_JP, SpeechModeEnum.CLASSIC_EN]:
+        # say コマンドは再生時に合成する
+        return AudioInfo(text=text_for_tts, mode=mode)
+    else:
+        raise ValueError(f"Invalid mode: {mode}")
+
+
+def synthesize_to_file(text: str, path: str, voice: str = "ja-JP-Neural2-B") -> AudioInfo:
+    """
+    Google の Text-to-Speech API で text の音声を合成し，MP3 ファイルとして path に保存する．
+    """
+    this_directory = os.path.dirname(__file__)
+    text_for_tts = convert_text_for_speech(text)
+    proc = subprocess.run(
+        ["sh", "./tts.sh", text_for_tts, os.path.abspath(path), voice],
+        cwd=this_directory,
+        stdout=subprocess.PIPE
+    )
+    path_to_audio_file = proc.stdout.decode("utf-8").strip()
+    # Standard の声とそれ以外（Neural2 等）とで，無料枠が別になっている
+    quota_governor.record("google_tts_standard" if "-Standard-" in voice else "google_tts", len(text_for_tts))
+    try:
+        duration_sec = get_mp3_duration(path_to_audio_file)
+    except Exception:
+        duration_sec = None
+    return AudioInfo(text=text_for_tts, mode=SpeechModeEnum.NEURAL_JP, path=path_to_audio_file, duration_sec=duration_sec)
+
+
+async def synthesize_async(text: str, mode: SpeechModeEnum) -> AudioInfo:
+    """
+    synthesize をイベントループを止めずに実行する．
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, synthesize, text, mode)
+
+
+def play(audio: AudioInfo, callback: Optional[Callable] = None) -> None:
+    """
+    合成済みの音声を再生する（再生終了まで待たない．再生終了時に callback 実行）．
+    """
+    this_directory = os.path.dirname(__file__)
+    if audio.mode is SpeechModeEnum.NEURAL_JP:
+        assert audio.path is not None
+
+        def _on_exit():
+            # 再生し終わった音声ファイルは消す
+            if audio.path is not None and os.path.exists(audio.path):
+                os.remove(audio.path)
+            if callback is not None:
+                callback()
+
         popen_with_callback(
-            callback,
-            ["mpg123", "-q", path_to_audio_file],
+            _on_exit,
+            ["mpg123", "-q", audio.path],
             cwd=this_directory
         )
-    elif mode is SpeechModeEnum.CLASSIC_JP:
+    elif audio.mode is SpeechModeEnum.CLASSIC_JP:
         # 日本語を雑に喋る
-        text_for_tts = convert_text_for_speech(text)
         popen_with_callback(
             callback,
-            ["say", "-v", "Kyoko", text_for_tts]
+            ["say", "-v", "Kyoko", audio.text]
         )
-    elif mode is SpeechModeEnum.CLASSIC_EN:
+    elif audio.mode is SpeechModeEnum.CLASSIC_EN:
         # 英語を雑に喋る
-        text_for_tts = convert_text_for_speech(text)
         popen_with_callback(
             callback,
-            ["say", "-v", "Samantha", text_for_tts]
+            ["say", "-v", "Samantha", audio.text]
         )
     else:
-        raise ValueError(f"Invalid mode: {mode}")
+        raise ValueError(f"Invalid mode: {audio.mode}")
+
+
+def speak(
+    text: str,
+    mode: SpeechModeEnum,
+    callback: Optional[Callable] = None
+) -> AudioInfo:
+    """
+    text を喋る．
+    """
+    audio = synthesize(text, mode)
+    play(audio, callback=callback)
+    return audio
 
 
 def convert_text_for_speech(text: str) -> str:
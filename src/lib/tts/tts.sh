@@ -1,12 +1,15 @@
 #!/bin/sh
-cat <<EOF > ./tmp/_.json
+# Usage: sh ./tts.sh TEXT [OUTPUT_MP3_PATH] [VOICE_NAME]
+OUT="${2:-./tmp/_.mp3}"
+VOICE="${3:-ja-JP-Neural2-B}"
+cat <<EOF > "${OUT%.mp3}.json"
 {
   "input": {
     "text": "$1"
   },
   "voice": {
-    "languageCode": "ja-JP",
-    "name": "ja-JP-Neural2-B"
+    "languageCode": "${VOICE%-*-*}",
+    "name": "$VOICE"
   },
   "audioConfig": {
     "audioEncoding": "MP3",
@@ -14,5 +17,6 @@ cat <<EOF > ./tmp/_.json
   }
 }
 EOF
-curl -s -X POST -H "Authorization: Bearer $(gcloud auth application-default print-access-token)" -H "Content-Type: application/json" -d @./tmp/_.json https://texttospeech.googleapis.com/v1/text:synthesize | jq -r .audioContent | base64 -d > ./tmp/_.mp3
-echo "$(pwd)/tmp/_.mp3"
+curl -s -X POST -H "Authorization: Bearer $(gcloud auth application-default print-access-token)" -H "Content-Type: application/json" -d @"${OUT%.mp3}.json" https://texttospeech.googleapis.com/v1/text:synthesize | jq -r .audioContent | base64 -d > "$OUT"
+rm -f "${OUT%.mp3}.json"
+echo "$(cd "$(dirname "$OUT")" && pwd)/$(basename "$OUT")"
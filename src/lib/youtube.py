@@ -2,14 +2,21 @@
 REF: https://qiita.com/iroiro_bot/items/ad0f3901a2336fe48e8f
 """
 import os
+from datetime import datetime
 from typing import List, Optional, Tuple
 
 import requests
 from pydantic import BaseModel
 
+from lib.quota import quota_governor
+
 # 事前に取得したYouTube API key
 YT_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
+# 各 API の 1 回あたりの quota コスト（units）
+QUOTA_COST_GET_CHAT_ID = 1
+QUOTA_COST_GET_CHAT = 5
+
 
 def get_chat_id(yt_url: str) -> Optional[str]:
     '''
@@ -21,6 +28,7 @@ def get_chat_id(yt_url: str) -> Optional[str]:
     url = 'https://www.googleapis.com/youtube/v3/videos'
     params = {'key': YT_API_KEY, 'id': video_id, 'part': 'liveStreamingDetails'}
     data = requests.get(url, params=params).json()
+    quota_governor.record("youtube", QUOTA_COST_GET_CHAT_ID)
 
     if data.get("status", "") == "PERMISSION_DENIED":
         raise RuntimeError("YouTube API failed due to permission denied.")
@@ -39,11 +47,26 @@ def get_chat_id(yt_url: str) -> Optional[str]:
 class ChatLog(BaseModel):
     name: str
     message: str
+    source: str = "youtube"  # チャットの送り元（youtube, local, replay 等）
+    time: Optional[float] = None  # 投稿時刻（UNIX 時間）
+
+
+def parse_published_at(published_at: Optional[str]) -> Optional[float]:
+    """
+    YouTube Data API の publishedAt（ISO 8601）を UNIX 時間に変換する．
+    """
+    if published_at is None:
+        return None
+    try:
+        return datetime.fromisoformat(published_at.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
 
 
-def get_chat(chat_id: str, page_token: Optional[str]) -> Tuple[List[ChatLog], str]:
+def get_chat(chat_id: str, page_token: Optional[str]) -> Tuple[List[ChatLog], str, Optional[float]]:
     '''
     https://developers.google.com/youtube/v3/live/docs/liveChatMessages/list
+    チャットの一覧，次のページのトークン，API が指定する次の取得までの待ち時間（秒）を返す．
     '''
     url = 'https://www.googleapis.com/youtube/v3/liveChat/messages'
     params = {'key': YT_API_KEY, 'liveChatId': chat_id, 'part': 'id,snippet,authorDetails'}
@@ -51,19 +74,22 @@ def get_chat(chat_id: str, page_token: Optional[str]) -> Tuple[List[ChatLog], st
         params['pageToken'] = page_token
 
     data = requests.get(url, params=params).json()
+    quota_governor.record("youtube", QUOTA_COST_GET_CHAT)
 
     chat_logs: List[ChatLog] = []
     try:
         chat_logs = [ChatLog(
             name=item['authorDetails']['displayName'],
-            message=item['snippet']['displayMessage']
+            message=item['snippet']['displayMessage'],
+            time=parse_published_at(item['snippet'].get('publishedAt'))
         ) for item in data['items']]
         # print("start : ", data['items'][0]['snippet']['publishedAt'])
         # print("end   : ", data['items'][-1]['snippet']['publishedAt'])
     except Exception:
         pass
 
-    return chat_logs, data.get('nextPageToken', None)
+    polling_interval_millis = data.get('pollingIntervalMillis', None)
+    return chat_logs, data.get('nextPageToken', None), polling_interval_millis / 1000 if polling_interval_millis is not None else None
 
 
 class ChatMonitor:
@@ -74,12 +100,13 @@ class ChatMonitor:
             raise ValueError("Not Live")
         self.chat_id = chat_id
         self.next_page_token: Optional[str] = None
+        self.polling_interval_sec: Optional[float] = None  # API が指定する次の取得までの待ち時間
 
     def get_recent_chats(self) -> List[ChatLog]:
         """
         最新のチャットの一覧を取得する（前回実行時から差分のみ）
         """
-        chat_logs, self.next_page_token = get_chat(
+        chat_logs, self.next_page_token, self.polling_interval_sec = get_chat(
             self.chat_id,
             self.next_page_token
         )
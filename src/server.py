@@ -4,25 +4,40 @@
 """
 import asyncio
 import json
-from typing import Dict, List, Optional, cast
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple, cast
 import argparse
 
 import websockets
+from langchain.chains.conversation.memory import ConversationSummaryMemory
 from websockets.server import WebSocketServerProtocol
 from websockets.typing import Data
 
 from agent import execute_agent_mock, execute_agent_with_subprocess
 from lib.gptuber import Action, GPTuber
-from lib.chains import TVGenerator, streamer_chain
-from lib.utils import random_choice
+from lib.chains import STREAMER_FILLER_LINES, TVGenerator, predict_streamer_multi_without_memory, predict_streamer_without_memory, streamer_chain
+from lib.llm_client import llm_client
+from lib.utils import get_error_message, random_choice
 from lib.youtube import ChatLog, ChatMonitor, MockChatMonitor
 from lib.chains import NewsGenerator, CMGenerator
+from lib.chat_bus import ChatBus, poll_youtube, replay_chats
+from lib.long_term_memory import LongTermMemory
+from lib.monitor import LoopWatchdog, profile_for
+from lib.quota import QuotaLevelEnum, quota_governor, quota_loop
+from lib.render import ScriptRecorder, synthesize_segments, write_outputs
+from lib.simulation import SimulatedChatSource, SimulatedSpeaker, VirtualTimeEventLoop
+from lib.snapshot import load_snapshot, restore_snapshot, snapshot_loop
+from lib.tts.browser import BrowserAudioPlayer
+from lib.tts.tts import FnPlay, FnSynthesize, play, synthesize_async
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, chat_bus: ChatBus, profile_path: str = "./profile.folded"):
         self.web_socket: Optional[WebSocketServerProtocol] = None
-        self.chat_list: List[ChatLog] = []
+        self.chat_bus = chat_bus
+        self.profile_path = profile_path
 
     async def on_message(self, websocket: WebSocketServerProtocol, path: str):
 
@@ -33,7 +48,13 @@ class Server:
             print(f"Received message: {message!r}") 
             obj = json.loads(message)
             if obj["type"] == "chat":
-                self.chat_list.append(ChatLog(name="", message=obj["message"]))
+                self.chat_bus.push(ChatLog(name=obj.get("name", ""), message=obj["message"], source="local"))
+            elif obj["type"] == "profile":
+                # 実行中にプロファイルを採取する（例: { "type": "profile", "sec": 30 }）
+                asyncio.create_task(profile_for(float(obj.get("sec", 30)), self.profile_path))
+            elif obj["type"] == "quota":
+                # 外部 API の利用枠の残りを返す（例: { "type": "quota" }）
+                self.send_message(json.dumps({"type": "quota", "metrics": quota_governor.metrics}, ensure_ascii=False))
 
     async def main(self):
         async with websockets.serve(self.on_message, "localhost", 8080):
@@ -43,71 +64,381 @@ class Server:
         if self.web_socket is not None:
             asyncio.create_task(self.web_socket.send(message))
 
-    def get_recent_chats(self) -> List[ChatLog]:
-        """
-        チャット（差分のみ）を返す．
-        """
-        chat_list = self.chat_list
-        self.chat_list = []
-        return chat_list
-
 
 async def run(
     youtube_url: Optional[str] = None,
     no_llm: bool = False,
     no_neural_tts: bool = False,
-    no_smart_agent: bool = False
+    no_smart_agent: bool = False,
+    snapshot_path: str = "./snapshot.json",
+    resume: bool = False,
+    speculative: bool = False,
+    stream_llm: bool = False,
+    multi_reply: bool = False,
+    lag_threshold_sec: float = 0.5,
+    profile_sec: Optional[float] = None,
+    profile_path: str = "./profile.folded",
+    long_term_memory_path: Optional[str] = None,
+    chat_bus_capacity: int = 1000,
+    max_chats_per_turn: int = 20,
+    replay_chats_path: Optional[str] = None,
+    browser_audio: bool = False
 ):
+    # 過去のやりとりから，関連するものをプロンプトに挿入するための長期記憶
+    long_term_memory = LongTermMemory(path=long_term_memory_path) if long_term_memory_path is not None else None
+
+    def _fn_noop() -> None:
+        pass
+
+    def _fn_streamer_llm_fallback() -> Tuple[Dict[str, Optional[str]], Callable[[], None]]:
+        # LLM が使えない間は，つなぎの台詞で沈黙を避ける（メモリーは更新しない）
+        return {"text": random_choice(STREAMER_FILLER_LINES)}, _fn_noop
+
+    def _predict_streamer(query: str, fn_fallback: Optional[Callable] = None) -> Tuple[Action, Callable[[], None]]:
+        # メモリーを更新しない呼び出しなので，ヘッジ（重複リクエスト）しても安全
+        context = long_term_memory.build_context(query) if long_term_memory is not None else ""
+        pred_raw, fn_commit = llm_client.call(
+            predict_streamer_without_memory, query, streaming=stream_llm, context=context, fn_fallback=fn_fallback
+        )
+        action = Action(**pred_raw)
+
+        def _fn_commit() -> None:
+            if fn_commit is _fn_noop:
+                return
+            try:
+                # 要約の計算のみがリトライされ，メモリーへの反映は 1 回だけ行われる
+                fn_commit()
+            except Exception:
+                # 要約の更新に失敗しても，返答自体は使う
+                print(get_error_message(), file=sys.stderr)
+            if long_term_memory is not None:
+                long_term_memory.add(query, action.text)
+
+        return action, _fn_commit
+
     def _fn_streamer_llm(query: str) -> Action:
-        pred_raw = cast(Dict[str, str], streamer_chain.predict_and_parse(input=query))
-        return Action(**pred_raw)
+        action, fn_commit = _predict_streamer(query, fn_fallback=_fn_streamer_llm_fallback)
+        fn_commit()
+        return action
 
     def _fn_streamer_llm_mock(query: str) -> Action:
         return Action(text="こんにちは。今日はいい天気ですね。")
 
+    def _fn_streamer_llm_multi_fallback() -> Tuple[List[Dict[str, Optional[str]]], Callable[[], None]]:
+        return [], _fn_noop
+
+    def _fn_streamer_llm_multi(query: str) -> List[Action]:
+        # メモリーを更新しない呼び出しなので，ヘッジしても安全．失敗時は空を返し，通常の返答にフォールバックさせる．
+        context = long_term_memory.build_context(query) if long_term_memory is not None else ""
+        preds_raw, fn_commit = llm_client.call(
+            predict_streamer_multi_without_memory, query, context=context, fn_fallback=_fn_streamer_llm_multi_fallback
+        )
+        actions = [Action(**pred_raw) for pred_raw in preds_raw]
+        if len(actions) == 0:
+            # 使わない返答はメモリーに反映しない（フォールバック先の返答のみが反映される）
+            return []
+        try:
+            fn_commit()
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+        if long_term_memory is not None:
+            long_term_memory.add(query, " ".join(action.text for action in actions))
+        return actions
+
+    def _fn_streamer_llm_multi_mock(query: str) -> List[Action]:
+        return [_fn_streamer_llm_mock(query) for _ in query.strip().split("\n")[:3]]
+
+    def _fn_streamer_llm_speculative(query: str) -> Tuple[Action, Callable[[], None]]:
+        return _predict_streamer(query)
+
+    def _fn_streamer_llm_speculative_mock(query: str) -> Tuple[Action, Callable[[], None]]:
+        return _fn_streamer_llm_mock(query), lambda: None
+
     chat_monitor = ChatMonitor(youtube_url) if youtube_url is not None else MockChatMonitor()
+    # YouTube Live・WebSocket・リプレイファイルからのチャットは，全てチャットバスに流れる
+    chat_bus = ChatBus(capacity=chat_bus_capacity)
+    chat_cursor = chat_bus.cursor()
 
     def _fn_get_recent_chats() -> List[ChatLog]:
-        chats_from_youtube = chat_monitor.get_recent_chats()
-        chats_from_local = server.get_recent_chats()
-        return chats_from_youtube + chats_from_local
+        num_dropped = chat_cursor.num_dropped
+        chats = chat_bus.read(chat_cursor, max_items=max_chats_per_turn)
+        if chat_cursor.num_dropped > num_dropped:
+            print(f"{chat_cursor.num_dropped - num_dropped} chats are dropped. {chat_bus.stats=}")
+        return chats
 
     async def _fn_distract() -> str:
+        if quota_governor.level("openai") >= QuotaLevelEnum.SAVING:
+            # OpenAI の利用枠を節約する場合は，TV の放送内容を生成しない
+            return await _fn_distract_mock()
         generators: List[TVGenerator] = [
             NewsGenerator(),
             CMGenerator()
         ]
-        return await random_choice(generators).generate()
+        try:
+            return await random_choice(generators).generate()
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+            return "（放送休止中）"
 
     async def _fn_distract_mock() -> str:
         return "テスト放送中"
 
-    server = Server()
+    server = Server(chat_bus, profile_path=profile_path)
+    fn_synthesize: FnSynthesize = synthesize_async
+    fn_play: FnPlay = play
+    if browser_audio:
+        # ブラウザで再生する場合は，音声をバイナリフレームでフロントエンドに送る
+        browser_audio_player = BrowserAudioPlayer(server.send_message)
+        fn_synthesize = browser_audio_player.synthesize
+        fn_play = browser_audio_player.play
     gptuber = GPTuber(
         _fn_streamer_llm_mock if no_llm else _fn_streamer_llm,
         fn_get_recent_chats=_fn_get_recent_chats,
         fn_distract=_fn_distract_mock if no_llm else _fn_distract,
         fn_send_message=server.send_message,
         fn_smart_agent=execute_agent_mock if no_smart_agent else execute_agent_with_subprocess,
-        no_neural_tts=no_neural_tts
+        no_neural_tts=no_neural_tts,
+        fn_streamer_llm_speculative=None if not speculative else (
+            _fn_streamer_llm_speculative_mock if no_llm else _fn_streamer_llm_speculative
+        ),
+        fn_streamer_llm_multi=None if not multi_reply else (
+            _fn_streamer_llm_multi_mock if no_llm else _fn_streamer_llm_multi
+        ),
+        fn_synthesize=fn_synthesize,
+        fn_play=fn_play,
+        quota_governor=quota_governor
     )
+    memory = None if no_llm else cast(ConversationSummaryMemory, streamer_chain.memory)
+    if resume:
+        # 前回のスナップショットから状態を復元する
+        snapshot = load_snapshot(snapshot_path)
+        if snapshot is not None:
+            restore_snapshot(snapshot, gptuber, memory=memory, chat_monitor=chat_monitor)
+            print(f"Resumed from snapshot. {snapshot_path=}")
+        else:
+            print(f"No snapshot to resume. {snapshot_path=}")
+    watchdog = LoopWatchdog(threshold_sec=lag_threshold_sec)
     await asyncio.gather(
         server.main(),
         gptuber.main_loop(),
-        gptuber.main_loop2()
+        gptuber.main_loop2(),
+        snapshot_loop(
+            snapshot_path,
+            gptuber,
+            memory=memory,
+            chat_monitor=chat_monitor,
+            chat_bus=chat_bus,
+            chat_cursor=chat_cursor,
+            max_chats_unread=max_chats_per_turn
+        ),
+        watchdog.run(),
+        quota_loop(quota_governor),
+        *([poll_youtube(chat_bus, chat_monitor, quota_governor=quota_governor)] if youtube_url is not None else []),
+        *([replay_chats(chat_bus, replay_chats_path)] if replay_chats_path is not None else []),
+        *([profile_for(profile_sec, profile_path)] if profile_sec is not None else [])
+    )
+
+
+def simulate(
+    hours: float,
+    chats_per_min: float = 1.0,
+    speculative: bool = False,
+    multi_reply: bool = False
+):
+    """
+    LLM・TTS・Agent をモックにして，仮想時刻で配信をシミュレーションする（実際には待たない）．
+    """
+    loop = VirtualTimeEventLoop()
+    asyncio.set_event_loop(loop)
+    speaker = SimulatedSpeaker()
+    chat_source = SimulatedChatSource(loop.unix_time, chats_per_min=chats_per_min, seed=0)
+
+    def _fn_streamer_llm_mock(query: str) -> Action:
+        if "OK Google" in query:
+            return Action(text="OK Google, 今日の天気は？", query_to_google_home="今日の天気は？")
+        return Action(text="こんにちは。今日はいい天気ですね。")
+
+    async def _fn_distract_mock() -> str:
+        return "テスト放送中"
+
+    gptuber = GPTuber(
+        _fn_streamer_llm_mock,
+        fn_get_recent_chats=chat_source.get_recent_chats,
+        fn_distract=_fn_distract_mock,
+        fn_smart_agent=execute_agent_mock,
+        fn_streamer_llm_speculative=(lambda query: (_fn_streamer_llm_mock(query), lambda: None)) if speculative else None,
+        fn_streamer_llm_multi=(lambda query: [_fn_streamer_llm_mock(row) for row in query.strip().split("\n")[:3]]) if multi_reply else None,
+        fn_time=loop.unix_time,
+        fn_synthesize=speaker.synthesize,
+        fn_play=speaker.play
     )
 
+    async def _main():
+        try:
+            await asyncio.wait_for(asyncio.gather(gptuber.main_loop(), gptuber.main_loop2()), timeout=hours * 60 * 60)
+        except asyncio.TimeoutError:
+            pass
+
+    t0 = time.time()
+    tracemalloc.start()
+    loop.run_until_complete(_main())
+    memory_current, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    loop.close()
+    print(json.dumps({
+        "virtual_sec": loop.time(),
+        "real_sec": time.time() - t0,
+        "num_chats": chat_source.num_chats,
+        "num_utterances": speaker.num_utterances,
+        "total_speech_sec": speaker.total_speech_sec,
+        "num_actions_reserved": len(gptuber.actions_reserved),
+        "num_chat_logs_pending": len(gptuber.chat_logs_pending),
+        "speculation_stats": gptuber.speculation_stats,
+        "memory_current_bytes": memory_current,
+        "memory_peak_bytes": memory_peak
+    }, ensure_ascii=False, indent=2))
+
+
+def render(
+    script_path: str,
+    out_dir: str,
+    duration_sec: Optional[float] = None,
+    no_llm: bool = False,
+    no_neural_tts: bool = False,
+    no_smart_agent: bool = False,
+    no_audio: bool = False,
+    max_workers: int = 4
+):
+    """
+    チャットの台本（--replay-chats と同じ形式）から，配信を実時間で待たずにレンダリングし，音声・字幕などのファイルを書き出す．
+    no_neural_tts の場合は，配信時と同じく標準の TTS の音声で合成する．no_audio の場合は音声を合成せず，字幕などのみを書き出す．
+    """
+    loop = VirtualTimeEventLoop()
+    asyncio.set_event_loop(loop)
+    recorder = ScriptRecorder()
+    chat_bus = ChatBus()
+    chat_cursor = chat_bus.cursor()
+
+    def _fn_streamer_llm(query: str) -> Action:
+        pred_raw, fn_commit = llm_client.call(predict_streamer_without_memory, query)
+        try:
+            fn_commit()
+        except Exception:
+            print(get_error_message(), file=sys.stderr)
+        return Action(**pred_raw)
+
+    def _fn_streamer_llm_mock(query: str) -> Action:
+        return Action(text="こんにちは。今日はいい天気ですね。")
+
+    gptuber = GPTuber(
+        _fn_streamer_llm_mock if no_llm else _fn_streamer_llm,
+        fn_get_recent_chats=lambda: chat_bus.read(chat_cursor, max_items=20),
+        fn_smart_agent=execute_agent_mock if no_smart_agent else execute_agent_with_subprocess,
+        no_neural_tts=no_neural_tts,
+        fn_time=loop.unix_time,
+        fn_synthesize=recorder.synthesize,
+        fn_play=recorder.play
+    )
+    if duration_sec is None:
+        # 台本の最後のチャットから 1 分後まで
+        with open(script_path, encoding="utf-8") as f:
+            offsets = [json.loads(line).get("offset_sec", 0.0) for line in f if line.strip() != ""]
+        duration_sec = max(offsets, default=0.0) + 60.0
+
+    async def _main():
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(gptuber.main_loop(), gptuber.main_loop2(), replay_chats(chat_bus, script_path)),
+                timeout=duration_sec
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    t0 = time.time()
+    loop.run_until_complete(_main())
+    loop.close()
+    print(f"{len(recorder.segments)} segments are generated in {time.time() - t0:.1f} sec.")
+    segments = synthesize_segments(recorder.segments, out_dir, max_workers=max_workers, no_tts=no_audio)
+    write_outputs(segments, out_dir)
+    quota_governor.save()
+    print(f"Rendered to {out_dir} in {time.time() - t0:.1f} sec.")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--youtube-url", type=str, help="YouTube Live URL, where the chat is monitored.")
     parser.add_argument("--no-llm", action="store_true", help="Don't use LLM.")
     parser.add_argument("--no-neural-tts", action="store_true", help="Don't use Neural TTS.")
     parser.add_argument("--no-smart-agent", action="store_true", help="Don't use Smart Agent.")
+    parser.add_argument("--snapshot-path", type=str, default="./snapshot.json", help="Path to the snapshot file of the streamer state.")
+    parser.add_argument("--resume", action="store_true", help="Resume the streamer state from the snapshot file.")
+    parser.add_argument("--stream-llm", action="store_true", help="Stream the LLM output and stop generating at the first completed line.")
+    parser.add_argument("--llm-timeout", type=float, default=20.0, help="Timeout (sec) of each LLM call.")
+    parser.add_argument("--llm-hedge-after", type=float, default=None, help="Send a duplicate LLM request if no response comes within this time (sec).")
+    parser.add_argument("--multi-reply", action="store_true", help="Reply to several audiences in one LLM call when the chat is busy.")
+    parser.add_argument("--speculative", action="store_true", help="Generate the next reply speculatively while the streamer is speaking.")
+    parser.add_argument("--lag-threshold", type=float, default=0.5, help="Print the stack when the event loop is blocked longer than this (sec).")
+    parser.add_argument("--profile", type=float, default=None, help="Capture a sampling profile for this many seconds from startup.")
+    parser.add_argument("--profile-path", type=str, default="./profile.folded", help="Output path of the sampling profile (folded stacks).")
+    parser.add_argument("--long-term-memory", type=str, default=None, help="Path to the long-term memory file (jsonl). If given, related past turns are inserted into the prompt.")
+    parser.add_argument("--chat-bus-capacity", type=int, default=1000, help="Max number of chats kept in the chat bus.")
+    parser.add_argument("--max-chats-per-turn", type=int, default=20, help="Max number of chats reported to the LLM per turn (older ones are skipped).")
+    parser.add_argument("--replay-chats", type=str, default=None, help="Path to a jsonl chat file to replay into the chat bus.")
+    parser.add_argument("--browser-audio", action="store_true", help="Send the audio to the browser over WebSocket instead of playing it on this machine.")
+    parser.add_argument("--quota-path", type=str, default="./quota.json", help="Path to the file of the API usage counters.")
+    parser.add_argument("--openai-monthly-requests", type=int, default=None, help="Monthly budget of OpenAI requests. Unlimited if not given.")
+    parser.add_argument("--render-script", type=str, default=None, help="Render offline from this jsonl chat script (same format as --replay-chats), and exit.")
+    parser.add_argument("--render-out", type=str, default="./render", help="Output directory of the offline rendering.")
+    parser.add_argument("--render-no-audio", action="store_true", help="Write only the subtitles and so on, without synthesizing the audio in the offline rendering.")
+    parser.add_argument("--render-duration", type=float, default=None, help="Length (sec) of the offline rendering. Defaults to 60 sec after the last chat.")
+    parser.add_argument("--simulate-hours", type=float, default=None, help="Simulate a stream of this length with mocks on a virtual clock, and exit.")
+    parser.add_argument("--simulate-chats-per-min", type=float, default=1.0, help="Chat rate used in the simulation.")
     args = parser.parse_args()
 
+    # 外部 API の使用量は，配信・レンダリングのどちらでも数える
+    quota_governor.load(args.quota_path)
+    quota_governor.quotas["openai"].limit = args.openai_monthly_requests
+
+    if args.render_script is not None:
+        render(
+            args.render_script,
+            args.render_out,
+            duration_sec=args.render_duration,
+            no_llm=args.no_llm,
+            no_neural_tts=args.no_neural_tts,
+            no_smart_agent=args.no_smart_agent,
+            no_audio=args.render_no_audio
+        )
+        sys.exit(0)
+
+    if args.simulate_hours is not None:
+        simulate(
+            args.simulate_hours,
+            chats_per_min=args.simulate_chats_per_min,
+            speculative=args.speculative,
+            multi_reply=args.multi_reply
+        )
+        sys.exit(0)
+
+    llm_client.timeout_sec = args.llm_timeout
+    llm_client.hedge_after_sec = args.llm_hedge_after
+
     asyncio.run(run(
         youtube_url=args.youtube_url,
         no_llm=args.no_llm,
         no_neural_tts=args.no_neural_tts,
-        no_smart_agent=args.no_smart_agent
+        no_smart_agent=args.no_smart_agent,
+        snapshot_path=args.snapshot_path,
+        resume=args.resume,
+        speculative=args.speculative,
+        stream_llm=args.stream_llm,
+        multi_reply=args.multi_reply,
+        lag_threshold_sec=args.lag_threshold,
+        profile_sec=args.profile,
+        profile_path=args.profile_path,
+        long_term_memory_path=args.long_term_memory,
+        chat_bus_capacity=args.chat_bus_capacity,
+        max_chats_per_turn=args.max_chats_per_turn,
+        replay_chats_path=args.replay_chats,
+        browser_audio=args.browser_audio
     ))
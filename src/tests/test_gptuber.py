@@ -0,0 +1,47 @@
+"""
+投機的な生成の確認
+実行: cd ./src; python -m pytest tests
+"""
+import asyncio
+
+from lib.gptuber import Action, GPTuber
+
+
+def test_speculation_deferred_when_bored():
+    async def _main():
+        async def _fn_distract() -> str:
+            return "テスト放送中"
+
+        gptuber = GPTuber(
+            lambda query: Action(text="こんにちは。"),
+            fn_distract=_fn_distract,
+            fn_streamer_llm_speculative=lambda query: (Action(text="こんにちは。"), lambda: None)
+        )
+        gptuber.last_non_boring_time -= gptuber.boring_patience_sec + 1
+        gptuber.start_speculation()
+        assert gptuber.speculation is None
+        assert gptuber.speculation_stats["deferred"] == 1
+
+    asyncio.run(_main())
+
+
+def test_speculation_waits_for_previous_commit():
+    async def _main():
+        committed = []
+
+        async def _commit():
+            await asyncio.sleep(0.1)
+            committed.append(True)
+
+        def _fn_streamer_llm_speculative(query: str):
+            # 直前の投機がメモリーに反映されてから生成する
+            assert committed == [True]
+            return Action(text="こんにちは。"), lambda: None
+
+        gptuber = GPTuber(lambda query: Action(text="こんにちは。"), fn_streamer_llm_speculative=_fn_streamer_llm_speculative)
+        gptuber.speculation_commit = asyncio.create_task(_commit())
+        _, _, _, action, _ = await gptuber.speculate()
+        assert action.text == "こんにちは。"
+        assert gptuber.speculation_commit is None
+
+    asyncio.run(_main())
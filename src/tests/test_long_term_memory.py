@@ -0,0 +1,43 @@
+"""
+長期記憶の確認
+実行: cd ./src; python -m pytest tests
+"""
+import sys
+import threading
+
+from lib.long_term_memory import LongTermMemory
+
+
+def test_search_while_adding():
+    memory = LongTermMemory()
+    for i in range(5000):
+        memory.add(f"Audience: 猫の話{i}", f"猫はかわいいですね{i}")
+    errors = []
+
+    def _add():
+        try:
+            for i in range(500):
+                memory.add(f"Audience: 猫の話{i}", f"猫はかわいいですね{i}")
+        except Exception as e:
+            errors.append(e)
+
+    def _search():
+        try:
+            for _ in range(50):
+                memory.search("猫の話", skip_recent=0)
+        except Exception as e:
+            errors.append(e)
+
+    # スレッドの切り替えを頻繁にして，競合を起こりやすくする
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=_add), threading.Thread(target=_search)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert len(memory.search("猫", skip_recent=0)) == 3
@@ -0,0 +1,32 @@
+"""
+オフラインレンダリングの確認
+LLM の応答に実時間がかかっても，仮想時刻が先に進んでしまわずに発話が生成されることを確認します．
+実行: cd ./src; python -m pytest tests
+"""
+import json
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "dummy")  # chain の作成時に必要（実際には呼び出さない）
+
+import server  # noqa: E402
+
+
+def test_render_with_slow_llm(tmp_path, monkeypatch):
+    def _call_slow_llm(fn, *args, **kwargs):
+        time.sleep(0.3)
+        return {"text": "こんにちは。"}, lambda: None
+
+    monkeypatch.setattr(server.llm_client, "call", _call_slow_llm)
+    script_path = tmp_path / "chats.jsonl"
+    with open(script_path, "w", encoding="utf-8") as f:
+        for i in range(10):
+            f.write(json.dumps({"name": f"viewer{i}", "message": f"こんにちは{i}", "offset_sec": i * 15.0}, ensure_ascii=False) + "\n")
+
+    server.render(str(script_path), str(tmp_path / "render"), no_smart_agent=True, no_audio=True)
+
+    with open(tmp_path / "render" / "segments.json", encoding="utf-8") as f:
+        segments = json.load(f)
+    assert len(segments) >= 10
+    with open(tmp_path / "render" / "subtitles.vtt", encoding="utf-8") as f:
+        assert "こんにちは" in f.read()